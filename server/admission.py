@@ -0,0 +1,127 @@
+import os
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+import imageProxy
+import responseEncoding
+from auth import USERS_DB, verify_session_token
+from metrics import Counter, Gauge, record_fallback
+from rateLimit import RateLimiter
+from outfitGenerator import HARDCODED_OUTFITS
+from itemGenerator import HARDCODED_ITEMS, get_random_items
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32"))
+# Serve the hardcoded response instead of 429/503 where one exists
+ADMISSION_FALLBACK = os.getenv("ADMISSION_FALLBACK", "").lower() in ("1", "true", "yes")
+
+# Routes that reach the generators; everything else is admitted untouched
+GUARDED_ROUTES = {
+    ("GET", "/generate"),
+    ("POST", "/generate"),
+    ("POST", "/generate-profile"),
+    ("GET", "/generate-outfits"),
+    ("POST", "/generate-outfits"),
+    ("GET", "/generate-items"),
+    ("POST", "/generate-items"),
+    ("POST", "/jobs"),
+}
+
+SHED = Counter("outfitsync_shed_total", "Requests rejected by admission control", ("route", "reason"))
+ADMITTED = Gauge("outfitsync_admitted_in_flight", "Guarded requests currently admitted", ("route",))
+
+async def client_key(request: Request) -> str:
+    """
+    Identify the caller: the user behind a valid session token, or the IP
+    for everyone else. Unverified tokens fall back to the IP, so a client
+    can't mint a fresh bucket per request by sending random bearer strings.
+    The token check is served from the verified-token cache.
+    """
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token and token != "guest":
+        token_data = await verify_session_token(USERS_DB, token)
+        if token_data is not None:
+            return "user:" + token_data.email
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+def _fallback_outfits_get() -> Dict:
+    return {
+        "outfit_recommendations": HARDCODED_OUTFITS["outfit_recommendations"],
+        "status": "error",
+        "message": "Server busy, using default outfits",
+    }
+
+def _fallback_items() -> Dict:
+    return {
+        category: {"items": get_random_items(data["items"])}
+        for category, data in HARDCODED_ITEMS.items()
+    }
+
+# Hardcoded answers for shed requests, encoded once per variant on first use
+_FALLBACK_BUILDERS: Dict[Tuple[str, str], Tuple[str, Callable[[], Dict]]] = {
+    ("GET", "/generate-outfits"): ("outfits", _fallback_outfits_get),
+    ("POST", "/generate-outfits"): ("outfits", lambda: HARDCODED_OUTFITS),
+    ("GET", "/generate-items"): ("items", _fallback_items),
+    ("POST", "/generate-items"): ("items", _fallback_items),
+}
+
+def _shed(request: Request, route: Tuple[str, str], reason: str, retry_after: float) -> Response:
+    SHED.inc(route=f"{route[0]} {route[1]}", reason=reason)
+    fallback = _FALLBACK_BUILDERS.get(route) if ADMISSION_FALLBACK else None
+    if fallback is not None:
+        stage, build = fallback
+        base_url = imageProxy.base_url_for(request)
+        record_fallback(stage, "shed_" + reason)
+        return responseEncoding.respond_static(
+            request,
+            ("shed", route, base_url),
+            lambda: imageProxy.rewrite_urls(build(), base_url),
+            headers={"X-Load-Shed": reason},
+        )
+
+    status_code = 429 if reason == "rate_limited" else 503
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": "Too many requests" if status_code == 429 else "Server busy"},
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999))), "X-Load-Shed": reason},
+    )
+
+class Admission:
+    """
+    Sheds load in front of the generators: a per-client token bucket, then a
+    cap on concurrently admitted requests per route. Both checks are O(1)
+    and run on the event loop before any request body is read.
+    """
+
+    def __init__(self, limiter: Optional[RateLimiter] = None, max_concurrency: int = ADMISSION_MAX_CONCURRENCY):
+        self.limiter = limiter or RateLimiter()
+        self.max_concurrency = max_concurrency
+        self._in_flight: Dict[Tuple[str, str], int] = {}
+
+    async def __call__(self, request: Request, call_next):
+        route = (request.method, request.url.path)
+        if route not in GUARDED_ROUTES:
+            return await call_next(request)
+
+        allowed, retry_after = self.limiter.take(await client_key(request))
+        if not allowed:
+            return _shed(request, route, "rate_limited", retry_after)
+        if self._in_flight.get(route, 0) >= self.max_concurrency:
+            return _shed(request, route, "over_capacity", 1.0)
+
+        label = f"{route[0]} {route[1]}"
+        self._in_flight[route] = self._in_flight.get(route, 0) + 1
+        try:
+            with ADMITTED.track(route=label):
+                return await call_next(request)
+        finally:
+            self._in_flight[route] -= 1
+
+def install(app: FastAPI) -> Admission:
+    admission = Admission()
+    app.middleware("http")(admission)
+    return admission
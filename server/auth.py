@@ -1,54 +1,156 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+import asyncio
+import hashlib
+import multiprocessing
+import threading
+import time
 import os
-from dotenv import load_dotenv
+from startup import load_env_once, warmup
+from userStore import UserStore
+from metrics import record_cache
 
 # Load environment variables
-load_dotenv()
+load_env_once()
 
 # JWT Configuration
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-here")  # Change this in production
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Verified-token cache and bcrypt pool sizing
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+LOGIN_MAX_PENDING = int(os.getenv("LOGIN_MAX_PENDING", "64"))
+# Expired session rows are deleted on login, at most this often per worker
+SESSION_PURGE_INTERVAL = float(os.getenv("SESSION_PURGE_INTERVAL", "300"))
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-# Sample user database (replace with a real database in production)
-USERS_DB = {
-    "user@example.com": {
-        "email": "user@example.com",
-        "hashed_password": pwd_context.hash("password123"),
-        "full_name": "Demo User"
-    }
-}
+# Users and login sessions live in SQLite so every worker sees the same data
+USERS_DB = UserStore()
+
+@warmup("users")
+def ensure_demo_user() -> None:
+    # Only pay for the bcrypt hash when the store doesn't have the user yet.
+    # Runs after startup rather than at import so workers come up fast.
+    if USERS_DB.get("user@example.com") is None:
+        USERS_DB.add_user("user@example.com", pwd_context.hash("password123"), "Demo User")
 
 class Token(BaseModel):
     access_token: str
     token_type: str
 
 class TokenData(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     email: Optional[str] = None
 
 class User(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     email: str
     full_name: Optional[str] = None
 
 class UserInDB(User):
     hashed_password: str
 
+class LoginBusyError(Exception):
+    """Raised when too many password checks are already queued."""
+
+GUEST_USER = User(email="guest@example.com", full_name="Guest User")
+
+# token digest -> (exp timestamp, TokenData), in LRU order
+_token_cache: "OrderedDict[bytes, Tuple[float, TokenData]]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+# email -> immutable User shared across requests, in LRU order
+_public_users: "OrderedDict[str, User]" = OrderedDict()
+
+_bcrypt_pool: Optional[ProcessPoolExecutor] = None
+_bcrypt_slots: Optional[asyncio.Semaphore] = None
+_bcrypt_pending = 0
+_last_session_purge = 0.0
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+def _get_bcrypt_pool() -> ProcessPoolExecutor:
+    global _bcrypt_pool
+    if _bcrypt_pool is None:
+        # Not fork: by now the process runs the event loop and the log
+        # listener thread, and a forked child can inherit their locks held.
+        _bcrypt_pool = ProcessPoolExecutor(
+            max_workers=BCRYPT_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+        )
+    return _bcrypt_pool
+
+@warmup("bcrypt-pool")
+def _start_bcrypt_pool() -> None:
+    # Fork the worker processes now instead of on the first login
+    _get_bcrypt_pool().submit(int).result()
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """
+    Run bcrypt verification in the process pool so the event loop stays free.
+    At most BCRYPT_WORKERS checks run at once; once LOGIN_MAX_PENDING callers
+    are waiting, further callers get LoginBusyError instead of queueing.
+    """
+    global _bcrypt_slots, _bcrypt_pending
+    if _bcrypt_slots is None:
+        _bcrypt_slots = asyncio.Semaphore(BCRYPT_WORKERS)
+    if _bcrypt_pending >= LOGIN_MAX_PENDING:
+        raise LoginBusyError("Too many concurrent login attempts")
+
+    _bcrypt_pending += 1
+    try:
+        async with _bcrypt_slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                _get_bcrypt_pool(), verify_password, plain_password, hashed_password
+            )
+    finally:
+        _bcrypt_pending -= 1
+
 def get_user(db, email: str):
-    if email in db:
-        user_dict = db[email]
+    user_dict = db.get(email)
+    if user_dict is not None:
+        return UserInDB(**user_dict)
+    return None
+
+async def get_user_async(db, email: str):
+    user_dict = await db.get_async(email)
+    if user_dict is not None:
         return UserInDB(**user_dict)
     return None
 
+async def get_public_user(db, email: str) -> Optional[User]:
+    """
+    Return the shared, immutable User for an email, building it once.
+    At most TOKEN_CACHE_SIZE users are kept, least recently used dropped.
+    """
+    with _token_cache_lock:
+        user = _public_users.get(email)
+        if user is not None:
+            _public_users.move_to_end(email)
+            return user
+    user_dict = await db.get_async(email)
+    if user_dict is None:
+        return None
+    user = User(email=user_dict["email"], full_name=user_dict.get("full_name"))
+    with _token_cache_lock:
+        _public_users[email] = user
+        _public_users.move_to_end(email)
+        while len(_public_users) > TOKEN_CACHE_SIZE:
+            _public_users.popitem(last=False)
+    return user
+
 def authenticate_user(db, email: str, password: str):
     user = get_user(db, email)
     if not user:
@@ -57,6 +159,14 @@ def authenticate_user(db, email: str, password: str):
         return False
     return user
 
+async def authenticate_user_async(db, email: str, password: str):
+    user = await get_user_async(db, email)
+    if not user:
+        return False
+    if not await verify_password_async(password, user.hashed_password):
+        return False
+    return user
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -75,4 +185,76 @@ def verify_token(token: str) -> Optional[TokenData]:
             return None
         return TokenData(email=email)
     except JWTError:
-        return None 
\ No newline at end of file
+        return None
+
+def token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+async def start_session(db, email: str) -> str:
+    """
+    Issue an access token for `email` and record it in the session store so
+    any worker can accept it.
+    """
+    expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(data={"sub": email}, expires_delta=expires_delta)
+    expires_at = time.time() + expires_delta.total_seconds()
+    await db.create_session_async(token_digest(access_token), email, expires_at)
+    await _maybe_purge_sessions(db)
+    return access_token
+
+async def _maybe_purge_sessions(db) -> None:
+    global _last_session_purge
+    now = time.monotonic()
+    if now - _last_session_purge < SESSION_PURGE_INTERVAL:
+        return
+    _last_session_purge = now
+    await db.purge_expired_sessions_async()
+
+async def end_session(db, token: str) -> None:
+    """
+    Revoke `token`: drop its session row and this worker's cached
+    verification. Other workers may still accept it from their own cache
+    until it expires.
+    """
+    key = token_digest(token)
+    with _token_cache_lock:
+        _token_cache.pop(key, None)
+    await db.delete_session_async(key)
+
+async def verify_session_token(db, token: str) -> Optional[TokenData]:
+    """
+    Like verify_token, but also requires a live session in `db` and remembers
+    successfully verified tokens until their `exp`. Entries are keyed by a
+    SHA-256 digest so raw tokens are never held. Invalid tokens are not cached.
+    """
+    key = token_digest(token)
+    now = time.time()
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                _token_cache.move_to_end(key)
+                record_cache("token", True)
+                return entry[1]
+            del _token_cache[key]
+    record_cache("token", False)
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    email = payload.get("sub")
+    exp = payload.get("exp")
+    if email is None or exp is None:
+        return None
+    session = await db.get_session_async(key)
+    if session is None or session["email"] != email:
+        return None
+    token_data = TokenData(email=email)
+
+    with _token_cache_lock:
+        _token_cache[key] = (min(float(exp), session["expires_at"]), token_data)
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return token_data
@@ -0,0 +1,113 @@
+import json
+import random
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import auth
+import itemGenerator
+import profileGenerator
+import responseEncoding
+from userStore import UserStore
+from fakeWorkersAI import PROFILE
+
+random.seed(7)
+
+FILENAMES = [
+    random.choice([
+        f"{i}.jpg",
+        f"IMG_{i:05d}.jpeg",
+        f"casual_look_{i}.png",
+        f"Formal-Event-{i}.JPG",
+        f"traditional_{i}_kurta.jpg",
+        f"photo {i} (copy).png",
+    ])
+    for i in range(5000)
+]
+
+CATALOG = [
+    {"url": f"https://cdn.example.com/items/{i}.jpg", "description": f"Catalog item number {i}"}
+    for i in range(100_000)
+]
+
+PROFILE_JSON = json.dumps(PROFILE)
+LARGE_PROFILE_JSON = json.dumps({
+    **PROFILE,
+    "Hobbies": [f"Hobby {i}" for i in range(500)],
+    "Notes": "x" * 20_000,
+})
+
+@pytest.fixture(scope="module")
+def large_image(tmp_path_factory):
+    path = tmp_path_factory.mktemp("images") / "large.jpg"
+    path.write_bytes(random.randbytes(5 * 1024 * 1024))
+    return str(path)
+
+@pytest.fixture(scope="module")
+def session_store(tmp_path_factory):
+    return UserStore(str(tmp_path_factory.mktemp("users") / "users.db"), pool_size=1)
+
+@pytest.fixture(scope="module")
+def token(session_store):
+    return asyncio.run(auth.start_session(session_store, "user@example.com"))
+
+def _resolve(coro):
+    # A token-cache hit never suspends, so drive the coroutine by hand and
+    # measure the lookup rather than an event loop round trip.
+    try:
+        coro.send(None)
+    except StopIteration as done:
+        return done.value
+    coro.close()
+    raise AssertionError("verify_session_token suspended; expected a cache hit")
+
+def bench_detect_category_main(benchmark, within, main_module):
+    detect = main_module.detect_category_from_filename
+    benchmark(lambda: [detect(name) for name in FILENAMES])
+    within(0.05)
+
+def bench_detect_category_items(benchmark, within):
+    detect = itemGenerator.detect_category_from_filename
+    benchmark(lambda: [detect(name) for name in FILENAMES])
+    within(0.05)
+
+def bench_get_random_items_large_catalog(benchmark, within):
+    benchmark(itemGenerator.get_random_items, CATALOG)
+    within(0.001)
+
+def bench_fallback_items(benchmark, within):
+    benchmark(itemGenerator.fallback_items, "bench")
+    within(0.002)
+
+def bench_parse_profile_json(benchmark, within):
+    benchmark(json.loads, PROFILE_JSON)
+    within(0.0005)
+
+def bench_parse_large_profile_json(benchmark, within):
+    benchmark(json.loads, LARGE_PROFILE_JSON)
+    within(0.005)
+
+def bench_dumps_items(benchmark, within):
+    benchmark(responseEncoding.dumps, itemGenerator.HARDCODED_ITEMS)
+    within(0.0005)
+
+def bench_gzip_items(benchmark, within):
+    body = responseEncoding.dumps(itemGenerator.HARDCODED_ITEMS)
+    benchmark(responseEncoding.compress, body, "gzip")
+    within(0.002)
+
+def bench_encode_large_image(benchmark, within, large_image):
+    benchmark(profileGenerator.encode_image_message, large_image)
+    within(0.1)
+
+def bench_create_access_token(benchmark, within):
+    benchmark(auth.create_access_token, {"sub": "user@example.com"}, timedelta(minutes=30))
+    within(0.005)
+
+def bench_verify_session_token_cached(benchmark, within, session_store, token):
+    # What get_current_user runs on every authenticated request
+    assert asyncio.run(auth.verify_session_token(session_store, token)) is not None
+    result = benchmark(lambda: _resolve(auth.verify_session_token(session_store, token)))
+    assert result is not None and result.email == "user@example.com"
+    within(0.0001)
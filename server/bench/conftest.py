@@ -0,0 +1,45 @@
+import os
+import sys
+import importlib
+
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+# Thresholds are mean seconds per call measured on a developer laptop; scale
+# them up on slower CI runners instead of editing the numbers.
+THRESHOLD_SCALE = float(os.getenv("BENCH_THRESHOLD_SCALE", "1.0"))
+
+@pytest.fixture(scope="session")
+def app_dir(tmp_path_factory):
+    """A scratch working directory laid out the way main.py expects."""
+    root = tmp_path_factory.mktemp("app")
+    for sub in ("img", "public/images", "data"):
+        (root / sub).mkdir(parents=True)
+    return root
+
+@pytest.fixture(scope="session")
+def main_module(app_dir):
+    cwd = os.getcwd()
+    os.chdir(app_dir)
+    try:
+        return importlib.import_module("main")
+    finally:
+        os.chdir(cwd)
+
+@pytest.fixture
+def within(benchmark):
+    """
+    Run after `benchmark(...)` to fail when the mean exceeds `limit` seconds.
+    Skipped under --benchmark-disable, where no stats are collected.
+    """
+    def check(limit: float) -> None:
+        stats = getattr(benchmark, "stats", None)
+        if stats is None:
+            return
+        mean = stats.stats.mean
+        assert mean <= limit * THRESHOLD_SCALE, (
+            f"{benchmark.name}: mean {mean * 1e6:.1f}us exceeds {limit * THRESHOLD_SCALE * 1e6:.1f}us"
+        )
+    return check
@@ -0,0 +1,195 @@
+"""
+A local stand-in for the Workers AI chat endpoint used by the generators.
+
+Point the server at it with CLOUDFLARE_API_BASE=http://127.0.0.1:<port>/client/v4.
+It also answers SerpAPI shopping searches (GET /search) for item resolution;
+set SERPAPI_BASE_URL=http://127.0.0.1:<port> and any SERPAPI_API_KEY.
+Latency, error rate and malformed-response rate are configurable so load
+tests can reproduce slow or flaky upstream behaviour without touching
+Cloudflare.
+
+    python bench/fakeWorkersAI.py --port 8787 --latency lognormal:-1.5,0.5 --error-rate 0.02
+"""
+import json
+import random
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+PROFILE = {
+    "Age": 27,
+    "Occupation": "Designer",
+    "Location": "Urban Area",
+    "Hobbies": ["Photography", "Cycling"],
+    "Ethnicity": "Not Specified",
+    "Attire Style": "Smart Casual",
+    "Style Archetype": "Minimalist",
+    "Color Palette": "Navy, White, Grey",
+    "Influence": "Scandinavian Design",
+}
+
+OUTFITS = {
+    "outfit_recommendations": [
+        {"url": f"https://example.com/outfit{i}.jpg", "description": f"Layered navy look #{i}"}
+        for i in range(4)
+    ]
+}
+
+ITEMS = {
+    "items": [
+        {"url": f"https://example.com/item{i}.jpg", "description": f"Grey merino knit #{i}"}
+        for i in range(5)
+    ]
+}
+
+def shopping_results(query: str) -> dict:
+    slug = "-".join(query.split()[:4]) or "item"
+    return {
+        "shopping_results": [
+            {
+                "title": query.title(),
+                "product_link": f"https://shop.example.com/p/{slug}",
+                "thumbnail": f"https://shop.example.com/img/{slug}.jpg",
+                "price": "$39.00",
+                "source": "Example Shop",
+            }
+        ]
+    }
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    Build a latency sampler (seconds) from "fixed:S", "uniform:LO,HI",
+    "normal:MEAN,STD" or "lognormal:MU,SIGMA".
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda: values[0] if values else 0.0
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+def _payload_for(system_prompt: str) -> dict:
+    prompt = system_prompt.lower()
+    if "customer profile" in prompt:
+        return PROFILE
+    if "outfit recommendations" in prompt:
+        return OUTFITS
+    return ITEMS
+
+class FakeWorkersAI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: str = "fixed:0",
+                 error_rate: float = 0.0, malformed_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+        if seed is not None:
+            random.seed(seed)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/client/v4"
+
+    @property
+    def search_base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                url = urlparse(self.path)
+                if url.path != "/search":
+                    self._send(404, b'{"error": "not found"}')
+                    return
+                time.sleep(fake.latency())
+                query = parse_qs(url.query).get("q", [""])[0]
+                self._send(200, json.dumps(shopping_results(query)).encode())
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length)
+                with fake._lock:
+                    fake.requests += 1
+                if "/ai/run/" not in self.path:
+                    self._send(404, b'{"success": false}')
+                    return
+
+                time.sleep(fake.latency())
+                roll = random.random()
+                if roll < fake.error_rate:
+                    status = random.choice([429, 500, 502, 503])
+                    self._send(status, json.dumps({"success": False, "errors": [{"code": status}]}).encode())
+                    return
+                if roll < fake.error_rate + fake.malformed_rate:
+                    self._send(200, json.dumps({"success": True, "result": {"response": "Sure! Here is {not json"}}).encode())
+                    return
+
+                try:
+                    messages = json.loads(raw)["messages"]
+                    system_prompt = messages[0]["content"]
+                except (ValueError, KeyError, IndexError):
+                    self._send(400, b'{"success": false}')
+                    return
+                body = {"success": True, "result": {"response": json.dumps(_payload_for(system_prompt))}}
+                self._send(200, json.dumps(body).encode())
+
+        return Handler
+
+    def start(self) -> "FakeWorkersAI":
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-workers-ai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", default="fixed:0.2")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    fake = FakeWorkersAI(args.host, args.port, args.latency, args.error_rate, args.malformed_rate, args.seed)
+    print(f"Fake Workers AI listening; set CLOUDFLARE_API_BASE={fake.base_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Drive the API at fixed concurrency levels against a fake Workers AI and
+report throughput, tail latency, fallback rate and server memory.
+
+Starts a FakeWorkersAI in-process and the app under uvicorn in a scratch
+directory, then runs each scenario at each concurrency level for a fixed
+duration. Results are written as JSON so runs can be compared:
+
+    python bench/loadTest.py --concurrency 1,8,32 --duration 10
+    python bench/loadTest.py --baseline bench/results/<earlier>.json
+
+Fallback counts come from /metrics, which is per process, so keep
+--workers at 1 when the fallback rate matters.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+from fakeWorkersAI import FakeWorkersAI, OUTFITS, PROFILE
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(SERVER_DIR, "bench", "results")
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def _rss_kb(pid: int) -> Optional[int]:
+    """Resident memory of `pid` and its descendants, in KiB (Linux only)."""
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except (OSError, ValueError):
+        return total or None
+    return total
+
+def _fallback_total(base_url: str) -> float:
+    text = requests.get(f"{base_url}/metrics", timeout=5).text
+    return sum(
+        float(line.rsplit(" ", 1)[1])
+        for line in text.splitlines()
+        if line.startswith("outfitsync_fallbacks_total")
+    )
+
+def _scenarios(token: str) -> Dict[str, Callable[[requests.Session, str], requests.Response]]:
+    profile_json = json.dumps(PROFILE)
+    auth = {"Authorization": f"Bearer {token}"}
+    image_bytes = os.urandom(64 * 1024)
+    return {
+        "GET /generate": lambda s, u: s.get(f"{u}/generate"),
+        "POST /generate": lambda s, u: s.post(
+            f"{u}/generate", headers=auth,
+            files=[("images", (f"casual{i}.jpg", image_bytes, "image/jpeg")) for i in range(3)],
+        ),
+        "POST /generate-profile": lambda s, u: s.post(f"{u}/generate-profile", json={"text": "Weekend cyclist, likes navy"}),
+        "POST /generate-outfits": lambda s, u: s.post(f"{u}/generate-outfits", json=PROFILE),
+        "GET /generate-outfits": lambda s, u: s.get(f"{u}/generate-outfits", params={"profile": profile_json}),
+        "POST /generate-items": lambda s, u: s.post(f"{u}/generate-items", json={"profile": PROFILE, **OUTFITS}),
+        "POST /login": lambda s, u: s.post(f"{u}/login", data={"username": "user@example.com", "password": "password123"}),
+    }
+
+def run_level(base_url: str, call: Callable, concurrency: int, duration: float) -> Dict[str, Any]:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        session = requests.Session()
+        local_latencies = []
+        local_statuses: Dict[str, int] = {}
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status = str(call(session, base_url).status_code)
+            except requests.RequestException:
+                status = "error"
+            local_latencies.append(time.perf_counter() - started)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": _ms(_percentile(latencies, 50)),
+        "p95_ms": _ms(_percentile(latencies, 95)),
+        "p99_ms": _ms(_percentile(latencies, 99)),
+        "max_ms": _ms(latencies[-1] if latencies else None),
+        "statuses": statuses,
+    }
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+def _start_server(workdir: str, port: int, workers: int, upstream_base: str) -> subprocess.Popen:
+    for sub in ("img", "public/images", "data"):
+        os.makedirs(os.path.join(workdir, sub), exist_ok=True)
+    for i in range(1, 4):
+        with open(os.path.join(workdir, "img", f"{i}.jpg"), "wb") as f:
+            f.write(os.urandom(256 * 1024))
+
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": SERVER_DIR,
+        "CLOUDFLARE_API_BASE": upstream_base,
+        "CLOUDFLARE_API_TOKEN": "bench-token",
+        "CLOUDFLARE_ACCOUNT_ID": "bench-account",
+        "USER_DB_PATH": os.path.join(workdir, "data", "users.db"),
+        "LOG_LEVEL": "WARNING",
+    })
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        cwd=workdir, env=env,
+    )
+
+def _wait_ready(base_url: str, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            report = requests.get(f"{base_url}/startup", timeout=1).json()
+            if not report.get("pending_warmups"):
+                return
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not become ready")
+
+def _login(base_url: str) -> str:
+    response = requests.post(f"{base_url}/login", data={"username": "user@example.com", "password": "password123"})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    old = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\n{'scenario':28} {'conc':>5} {'rps':>16} {'p99 ms':>20}")
+    for result in current["results"]:
+        before = old.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+        print(f"{result['scenario']:28} {result['concurrency']:>5} "
+              f"{before['rps']:>7} -> {result['rps']:<7} "
+              f"{before['p99_ms']:>9} -> {result['p99_ms']:<9}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario and level")
+    parser.add_argument("--scenarios", help="comma-separated subset, e.g. 'POST /generate-outfits,POST /login'")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--latency", default="lognormal:-1.6,0.6", help="fake upstream latency, see fakeWorkersAI.parse_latency")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--malformed-rate", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="result file (default: bench/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    fake = FakeWorkersAI(latency=args.latency, error_rate=args.error_rate,
+                         malformed_rate=args.malformed_rate, seed=args.seed).start()
+    workdir = tempfile.mkdtemp(prefix="outfitsync-bench-")
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = _start_server(workdir, port, args.workers, fake.base_url)
+
+    results = []
+    try:
+        _wait_ready(base_url)
+        scenarios = _scenarios(_login(base_url))
+        if args.scenarios:
+            wanted = set(args.scenarios.split(","))
+            scenarios = {name: call for name, call in scenarios.items() if name in wanted}
+
+        for name, call in scenarios.items():
+            for level in levels:
+                fallbacks_before = _fallback_total(base_url)
+                upstream_before = fake.requests
+                result = run_level(base_url, call, level, args.duration)
+                result["scenario"] = name
+                result["fallbacks"] = _fallback_total(base_url) - fallbacks_before
+                result["fallback_rate"] = round(result["fallbacks"] / max(result["requests"], 1), 4)
+                result["upstream_requests"] = fake.requests - upstream_before
+                result["server_rss_kb"] = _rss_kb(server.pid)
+                results.append(result)
+                print(f"{name:28} c={level:<4} rps={result['rps']:<8} p50={result['p50_ms']}ms "
+                      f"p95={result['p95_ms']}ms p99={result['p99_ms']}ms "
+                      f"fallback={result['fallback_rate']:.1%} rss={result['server_rss_kb']}KiB")
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Precompute profiles, outfits and items for a tree of per-user image folders.
+
+Every directory under ROOT that directly contains .jpg/.jpeg/.png files is
+one user. Folders run through generateProfile -> generateOutfits ->
+generateItems on a process pool, results stream to a JSONL file, and a
+checkpoint file records finished folders so an interrupted run resumes
+where it stopped. A folder is redone only if its images changed or its
+last run got the hardcoded fallback.
+
+    python bulk.py /data/users --output recs.jsonl --workers 8
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def find_user_folders(root: str) -> Iterator[Tuple[str, List[str]]]:
+    """Yield (folder relative to root, sorted image paths) for each user folder."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        images = sorted(f for f in filenames if f.lower().endswith(IMAGE_EXTENSIONS))
+        if images:
+            yield os.path.relpath(dirpath, root), [os.path.join(dirpath, f) for f in images]
+
+def fingerprint(image_files: List[str]) -> str:
+    """Cheap change detector: names, sizes and mtimes of a folder's images."""
+    digest = hashlib.sha256()
+    for path in image_files:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def load_checkpoint(path: str) -> Dict[str, str]:
+    done: Dict[str, str] = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash; everything before it is valid
+                continue
+            done[entry["folder"]] = entry["fingerprint"]
+    return done
+
+def _init_worker(log_level: str) -> None:
+    import startup
+    from logSetup import configure_logging
+    import scheduler
+
+    startup.load_env_once()
+    configure_logging(log_level)
+    # Bulk work is the lowest scheduling class in every worker process
+    scheduler.set_priority(scheduler.BATCH, "bulk")
+
+class FallbackResult(Exception):
+    """The pipeline answered with hardcoded data, e.g. upstream down or no credentials."""
+
+def _process_folder(folder: str, image_files: List[str]) -> Dict[str, Any]:
+    from pipeline import run_pipeline, used_fallback
+
+    started = time.perf_counter()
+    result = run_pipeline(image_files)
+    # Checked here: identity with the hardcoded dicts doesn't survive pickling.
+    # Failing the folder keeps it out of the checkpoint, so a rerun retries it.
+    if used_fallback(result):
+        raise FallbackResult("pipeline returned the hardcoded fallback")
+    return {"result": result, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+def _append(f, record: Dict[str, Any]) -> None:
+    f.write(json.dumps(record) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="directory tree of per-user image folders")
+    parser.add_argument("--output", default="recommendations.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: OUTPUT.checkpoint)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--max-in-flight", type=int, help="folders submitted at once (default: 2 x workers)")
+    parser.add_argument("--force", action="store_true", help="ignore the checkpoint and redo every folder")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    done = {} if args.force else load_checkpoint(checkpoint_path)
+    max_in_flight = args.max_in_flight or args.workers * 2
+
+    processed = skipped = failed = 0
+    started = time.perf_counter()
+    with open(args.output, "a") as output, open(checkpoint_path, "a") as checkpoint, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(args.log_level,)) as pool:
+        pending: Dict[Future, Tuple[str, str]] = {}
+
+        def drain(block: bool) -> None:
+            nonlocal processed, failed
+            if not pending:
+                return
+            finished, _ = wait(list(pending), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for future in finished:
+                folder, folder_print = pending.pop(future)
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    failed += 1
+                    _append(output, {"folder": folder, "fingerprint": folder_print, "status": "error", "error": str(e)})
+                    continue
+                processed += 1
+                # Output first, then checkpoint: a crash in between repeats
+                # the folder on resume rather than losing it.
+                _append(output, {"folder": folder, "fingerprint": folder_print, "status": "ok", **outcome})
+                _append(checkpoint, {"folder": folder, "fingerprint": folder_print})
+
+        for folder, image_files in find_user_folders(args.root):
+            folder_print = fingerprint(image_files)
+            if done.get(folder) == folder_print:
+                skipped += 1
+                continue
+            while len(pending) >= max_in_flight:
+                drain(block=True)
+            pending[pool.submit(_process_folder, folder, image_files)] = (folder, folder_print)
+            drain(block=False)
+
+        while pending:
+            drain(block=True)
+
+    elapsed = time.perf_counter() - started
+    print(f"processed={processed} skipped={skipped} failed={failed} in {elapsed:.1f}s", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
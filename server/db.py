@@ -0,0 +1,80 @@
+import os
+import queue
+import sqlite3
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+class SQLitePool:
+    """
+    A small pool of SQLite connections opened in WAL mode.
+
+    Connections are created lazily up to `size` and handed out one per caller,
+    so the pool can be shared by the threadpool that runs sync endpoints and,
+    through `run`, by async handlers. Each connection keeps its own prepared
+    statement cache, so repeated queries skip the SQL compile step.
+    """
+
+    def __init__(self, path: str, size: int = 8, init: Optional[Callable[[sqlite3.Connection], None]] = None):
+        self.path = path
+        self.size = size
+        self._init = init
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._slots = queue.Queue()
+        for _ in range(size):
+            self._slots.put(None)
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(
+            self.path,
+            timeout=5.0,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        if self._init is not None:
+            self._init(conn)
+        self._created += 1
+        logger.debug("Opened SQLite connection %d to %s", self._created, self.path)
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        # A slot token bounds the number of live connections at `size`.
+        self._slots.get()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.put(None)
+                raise
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+            self._slots.put(None)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run `fn(*args)` in a worker thread so async handlers never block on SQLite."""
+        return await asyncio.to_thread(fn, *args)
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
@@ -0,0 +1,95 @@
+import os
+import time
+import hashlib
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import record_cache
+from pipeline import used_fallback
+from sharedCache import CACHE
+
+INDEX_RESULT_TTL = float(os.getenv("INDEX_RESULT_TTL", "3600"))
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _is_real(result: Dict[str, Any]) -> bool:
+    return not used_fallback(result)
+
+class DirectoryIndex:
+    """
+    Tracks the image files in one directory by (name, size, mtime, content
+    hash). Each refresh is a single scandir; only files whose size or mtime
+    changed are re-hashed. The directory's state is the digest of its
+    (name, hash) pairs, and the last pipeline result is reused for as long
+    as that state doesn't change.
+    """
+
+    def __init__(self, directory: str, extensions: Tuple[str, ...], result_ttl: float = INDEX_RESULT_TTL):
+        self.directory = directory
+        self.extensions = extensions
+        self.result_ttl = result_ttl
+        # name -> (size, mtime_ns, sha256)
+        self._entries: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+        self._compute_lock = threading.Lock()
+        self._result: Optional[Tuple[str, float, Dict[str, Any]]] = None
+
+    def refresh(self) -> Tuple[str, List[str]]:
+        """Bring the index up to date. Returns (state digest, sorted paths)."""
+        seen: Dict[str, Tuple[int, int, str]] = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(self.extensions) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                known = self._entries.get(entry.name)
+                if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                    seen[entry.name] = known
+                else:
+                    seen[entry.name] = (stat.st_size, stat.st_mtime_ns, _hash_file(entry.path))
+
+        with self._lock:
+            self._entries = seen
+        names = sorted(seen)
+        state = hashlib.sha256(
+            "\n".join(f"{name}\0{seen[name][2]}" for name in names).encode("utf-8")
+        ).hexdigest()
+        return state, [os.path.join(self.directory, name) for name in names]
+
+    def get_or_compute(self, compute: Callable[[List[str]], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Return the cached result for the directory's current state, or run
+        `compute` on its files. Concurrent misses compute only once.
+        """
+        state, paths = self.refresh()
+        cached = self._fresh(state)
+        if cached is not None:
+            record_cache("image_index", True)
+            return cached
+
+        with self._compute_lock:
+            cached = self._fresh(state)
+            if cached is not None:
+                record_cache("image_index", True)
+                return cached
+            record_cache("image_index", False)
+            # Other workers index the same directory; the shared cache lets
+            # one of them run the pipeline for a new state and the rest reuse it
+            result = CACHE.get_or_compute(
+                "pipeline", state, lambda: compute(paths), ttl=self.result_ttl, cacheable=_is_real
+            )
+            # Don't pin a fallback answer to this state; retry next time
+            if _is_real(result):
+                self._result = (state, time.time(), result)
+            return result
+
+    def _fresh(self, state: str) -> Optional[Dict[str, Any]]:
+        cached = self._result
+        if cached is None or cached[0] != state or time.time() - cached[1] > self.result_ttl:
+            return None
+        return cached[2]
@@ -0,0 +1,316 @@
+import os
+import hmac
+import uuid
+import socket
+import ipaddress
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import quote, urljoin, urlsplit
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from starlette.requests import HTTPConnection
+
+import imageVariants
+from metrics import Counter, record_cache
+from startup import load_env_once
+
+logger = logging.getLogger(__name__)
+
+load_env_once()
+
+# Rewrite outgoing third-party image URLs to go through /img-proxy
+IMAGE_PROXY = os.getenv("IMAGE_PROXY", "1").lower() in ("1", "true", "yes")
+IMAGE_PROXY_DIR = os.getenv("IMAGE_PROXY_DIR", "data/img-proxy")
+IMAGE_PROXY_MAX_BYTES = int(os.getenv("IMAGE_PROXY_MAX_BYTES", str(512 * 1024 * 1024)))
+IMAGE_PROXY_MAX_SOURCE = int(os.getenv("IMAGE_PROXY_MAX_SOURCE", str(10 * 1024 * 1024)))
+IMAGE_PROXY_WIDTH = int(os.getenv("IMAGE_PROXY_WIDTH", "640"))
+IMAGE_PROXY_TIMEOUT = float(os.getenv("IMAGE_PROXY_TIMEOUT", "10"))
+IMAGE_PROXY_MAX_REDIRECTS = int(os.getenv("IMAGE_PROXY_MAX_REDIRECTS", "3"))
+# Only for local testing against an origin on loopback or a private network
+IMAGE_PROXY_ALLOW_PRIVATE = os.getenv("IMAGE_PROXY_ALLOW_PRIVATE", "").lower() in ("1", "true", "yes")
+# Externally visible base URL when behind a reverse proxy; otherwise taken from the request
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "")
+# Proxy URLs are signed so the endpoint only fetches URLs this server handed out
+IMAGE_PROXY_SECRET = (os.getenv("IMAGE_PROXY_SECRET") or os.getenv("JWT_SECRET_KEY", "your-secret-key-here")).encode("utf-8")
+
+ORIGIN_FETCHES = Counter("outfitsync_img_proxy_fetches_total", "Origin fetches by the image proxy", ("outcome",))
+
+_CONTENT_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+router = APIRouter()
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Pooled client for origin fetches, separate from the Workers AI pool."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def sign(url: str) -> str:
+    return hmac.new(IMAGE_PROXY_SECRET, url.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+def proxy_url(url: str, base_url: str, width: Optional[int] = IMAGE_PROXY_WIDTH) -> str:
+    """Absolute /img-proxy URL for a third-party image URL."""
+    path = f"{base_url.rstrip('/')}/img-proxy/{sign(url)}?url={quote(url, safe='')}"
+    return f"{path}&w={width}" if width else path
+
+def base_url_for(connection: HTTPConnection) -> str:
+    """Base URL for proxy links; WebSocket connections get the matching http(s) scheme."""
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL
+    base_url = connection.base_url
+    if base_url.scheme in ("ws", "wss"):
+        base_url = base_url.replace(scheme="https" if base_url.scheme == "wss" else "http")
+    return str(base_url)
+
+def rewrite_urls(payload: Any, base_url: str) -> Any:
+    """
+    Return a copy of a profile/outfits/items payload with every http(s)
+    `url` field pointed at the proxy; the original goes in `source_url`.
+    Never mutates the input, which may be a shared hardcoded fallback.
+    """
+    if not IMAGE_PROXY:
+        return payload
+    if isinstance(payload, list):
+        return [rewrite_urls(value, base_url) for value in payload]
+    if not isinstance(payload, dict):
+        return payload
+    rewritten = {}
+    for key, value in payload.items():
+        if key == "url" and isinstance(value, str) and value.startswith(("http://", "https://")):
+            rewritten[key] = proxy_url(value, base_url)
+            rewritten["source_url"] = value
+        else:
+            rewritten[key] = rewrite_urls(value, base_url)
+    return rewritten
+
+class DiskLRU:
+    """
+    Size-capped directory of immutable files, evicted least recently used
+    first. Recency is the file's mtime, bumped on every hit, so the order
+    survives restarts and is shared (loosely) between worker processes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files: Optional["OrderedDict[str, int]"] = None
+        self._total = 0
+
+    def _load(self) -> None:
+        files = []
+        os.makedirs(self.directory, exist_ok=True)
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime_ns, path, stat.st_size))
+        files.sort()
+        self._files = OrderedDict((path, size) for _, path, size in files)
+        self._total = sum(self._files.values())
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name[:2], name)
+
+    def touch(self, path: str) -> bool:
+        """Mark `path` as used. Returns False if it isn't cached."""
+        with self._lock:
+            if self._files is None:
+                self._load()
+            if path in self._files:
+                self._files.move_to_end(path)
+            elif os.path.exists(path):
+                # Written by another worker since we loaded
+                size = os.path.getsize(path)
+                self._files[path] = size
+                self._total += size
+            else:
+                return False
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by another worker
+            with self._lock:
+                self._total -= self._files.pop(path, 0)
+            return False
+        return True
+
+    def put(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+        with self._lock:
+            if self._files is None:
+                self._load()
+            self._total += len(data) - self._files.pop(path, 0)
+            self._files[path] = len(data)
+            while self._total > self.max_bytes and len(self._files) > 1:
+                victim, size = self._files.popitem(last=False)
+                self._total -= size
+                try:
+                    os.remove(victim)
+                except OSError:
+                    pass
+
+CACHE = DiskLRU(IMAGE_PROXY_DIR, IMAGE_PROXY_MAX_BYTES)
+
+# One fetch per cache entry at a time; concurrent misses wait for it
+_fetch_locks: Dict[str, threading.Lock] = {}
+_fetch_locks_guard = threading.Lock()
+
+class OriginBlocked(ValueError):
+    """The URL points somewhere the proxy must not fetch from."""
+
+def check_origin(url: str) -> None:
+    """
+    Raise OriginBlocked unless `url` is http(s) and its host resolves only
+    to public addresses. Proxied URLs come from model and search output,
+    which clients can steer, so the signature alone doesn't make them safe
+    to fetch from inside our network.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise OriginBlocked(f"unsupported URL: {parts.scheme or 'no scheme'}")
+    if IMAGE_PROXY_ALLOW_PRIVATE:
+        return
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                   type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise OriginBlocked(f"cannot resolve {parts.hostname}: {e}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise OriginBlocked(f"{parts.hostname} resolves to non-public address {address}")
+
+def _fetch(url: str) -> Tuple[bytes, str]:
+    # Redirects are followed by hand so every hop is checked. The host is
+    # resolved again to connect, so this doesn't stop DNS rebinding by an
+    # origin that deliberately flips its answer between the two lookups.
+    for _ in range(IMAGE_PROXY_MAX_REDIRECTS + 1):
+        check_origin(url)
+        response = get_session().get(url, timeout=IMAGE_PROXY_TIMEOUT, stream=True, allow_redirects=False)
+        if not response.is_redirect:
+            break
+        url = urljoin(url, response.headers["location"])
+        response.close()
+    else:
+        raise ValueError("too many redirects")
+    try:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "").split(";")[0].strip()
+        if not content_type.startswith("image/"):
+            raise ValueError(f"not an image: {content_type or 'no content type'}")
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > IMAGE_PROXY_MAX_SOURCE:
+                raise ValueError("image too large")
+        return bytes(data), _CONTENT_EXTENSIONS.get(content_type, ".img")
+    finally:
+        response.close()
+
+def _transform(data: bytes, ext: str, width: Optional[int], webp: bool) -> Tuple[bytes, str]:
+    """Resize/re-encode fetched bytes. Falls back to the original bytes and extension."""
+    if (width is None and not webp) or not imageVariants.has_pillow():
+        return data, ext
+    # .tmp names are skipped by DiskLRU and cleaned up here
+    source = os.path.join(IMAGE_PROXY_DIR, f"{uuid.uuid4().hex}{ext}.tmp")
+    target = os.path.join(IMAGE_PROXY_DIR, f"{uuid.uuid4().hex}.tmp")
+    os.makedirs(IMAGE_PROXY_DIR, exist_ok=True)
+    try:
+        with open(source, "wb") as f:
+            f.write(data)
+        imageVariants.render_variant(source, target, width, "webp" if webp else "original")
+        with open(target, "rb") as f:
+            return f.read(), ".webp" if webp else ext
+    except Exception as e:
+        logger.warning("Serving proxied image unresized: %s", e)
+        return data, ext
+    finally:
+        for path in (source, target):
+            if os.path.exists(path):
+                os.remove(path)
+
+@router.get("/img-proxy/{signature}", name="img-proxy")
+def serve_proxied(signature: str, url: str, request: Request, w: Optional[int] = None):
+    """
+    Serve a third-party image from the local cache, fetching it from its
+    origin once on the first request. Cached copies keep being served after
+    the origin URL expires.
+    """
+    if not hmac.compare_digest(signature, sign(url)):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    width = imageVariants.bucket_width(w)
+    webp = imageVariants.has_pillow() and imageVariants.wants_webp(request, None)
+    variant = f"{width or 'orig'}{'-webp' if webp else ''}"
+    etag = f'"{signature}-{variant}"'
+    if imageVariants.not_modified(request, etag):
+        return Response(status_code=304, headers=imageVariants.cache_headers(etag, vary=True))
+
+    key = f"{signature}-{variant}"
+    with _fetch_locks_guard:
+        lock = _fetch_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            path = _cached_path(key)
+            record_cache("image_proxy", path is not None)
+            if path is None:
+                try:
+                    data, ext = _fetch(url)
+                except OriginBlocked as e:
+                    ORIGIN_FETCHES.inc(outcome="blocked")
+                    logger.warning("Image proxy refused %s: %s", url, e)
+                    raise HTTPException(status_code=403, detail="Origin not allowed")
+                except Exception as e:
+                    ORIGIN_FETCHES.inc(outcome="error")
+                    logger.warning("Image proxy fetch failed for %s: %s", url, e)
+                    raise HTTPException(status_code=502, detail="Origin image unavailable")
+                ORIGIN_FETCHES.inc(outcome="ok")
+                data, ext = _transform(data, ext, width, webp)
+                path = CACHE.path(f"{key}{ext}")
+                CACHE.put(path, data)
+    finally:
+        # Best effort: a racing miss may create a fresh lock and fetch twice
+        with _fetch_locks_guard:
+            if not lock.locked():
+                _fetch_locks.pop(key, None)
+
+    ext = os.path.splitext(path)[1]
+    media_type = imageVariants.MEDIA_TYPES.get(ext, "application/octet-stream")
+    return imageVariants.cached_file_response(request, path, etag, media_type, vary=True)
+
+def _cached_path(key: str) -> Optional[str]:
+    for ext in (*_CONTENT_EXTENSIONS.values(), ".img"):
+        path = CACHE.path(key + ext)
+        if CACHE.touch(path):
+            return path
+    return None
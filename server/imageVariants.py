@@ -0,0 +1,183 @@
+import os
+import re
+import uuid
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+IMAGES_DIR = os.getenv("IMAGES_DIR", "public/images")
+VARIANT_CACHE_DIR = os.getenv("VARIANT_CACHE_DIR", "data/variants")
+WIDTH_BUCKETS = (160, 320, 640, 1280, 1920)
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "80"))
+
+# Variant URLs change whenever the source does (the ETag is content-derived),
+# so clients and CDNs may keep them forever.
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+# path -> (size, mtime_ns, sha256) so sources are hashed once per change
+_source_hashes: Dict[str, Tuple[int, int, str]] = {}
+_hash_lock = threading.Lock()
+
+router = APIRouter()
+
+def _pillow():
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    return Image, ImageOps
+
+def has_pillow() -> bool:
+    return _pillow() is not None
+
+def source_hash(path: str) -> str:
+    stat = os.stat(path)
+    known = _source_hashes.get(path)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    with _hash_lock:
+        _source_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
+
+def bucket_width(width: Optional[int]) -> Optional[int]:
+    """Round a requested width up to the nearest bucket, so a handful of variants serve every client."""
+    if width is None or width <= 0:
+        return None
+    for bucket in WIDTH_BUCKETS:
+        if width <= bucket:
+            return bucket
+    return WIDTH_BUCKETS[-1]
+
+def render_variant(source: str, target: str, width: Optional[int], fmt: str) -> None:
+    """
+    Write a resized and/or re-encoded copy of `source` to `target`. Never
+    upscales. The file is written under a temporary name and renamed, so
+    concurrent renders of the same variant can't expose a partial file.
+    """
+    Image, ImageOps = _pillow()
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        source_format = image.format
+        image = ImageOps.exif_transpose(image)
+        if width is not None and image.width > width:
+            image.thumbnail((width, image.height * width // image.width + 1))
+        temp = f"{target}.{uuid.uuid4().hex}.tmp"
+        if fmt == "webp":
+            image.save(temp, "WEBP", quality=WEBP_QUALITY, method=4)
+        else:
+            save_format = source_format or Image.registered_extensions().get(os.path.splitext(source)[1].lower(), "PNG")
+            if save_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(temp, save_format)
+    os.replace(temp, target)
+
+def _resolve_source(path: str) -> str:
+    root = os.path.realpath(IMAGES_DIR)
+    source = os.path.realpath(os.path.join(root, path))
+    if not source.startswith(root + os.sep) or not os.path.isfile(source):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return source
+
+def wants_webp(request: Request, fmt: Optional[str]) -> bool:
+    if fmt is not None:
+        return fmt == "webp"
+    return "image/webp" in request.headers.get("accept", "")
+
+def _range_response(path: str, range_header: str, headers: Dict[str, str], media_type: str) -> Response:
+    size = os.path.getsize(path)
+    match = _RANGE.match(range_header.strip())
+    if match is None or (not match.group(1) and not match.group(2)):
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    if start > end or start >= size:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    with open(path, "rb") as f:
+        f.seek(start)
+        body = f.read(end - start + 1)
+    headers = dict(headers, **{"Content-Range": f"bytes {start}-{end}/{size}"})
+    return Response(body, status_code=206, headers=headers, media_type=media_type)
+
+def cache_headers(etag: str, vary: bool) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if vary:
+        headers["Vary"] = "Accept"
+    return headers
+
+def not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")])
+
+def cached_file_response(request: Request, path: str, etag: str, media_type: str, vary: bool) -> Response:
+    """Serve an immutable file with its caching headers, honouring Range and If-Range."""
+    headers = cache_headers(etag, vary)
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        return _range_response(path, range_header, headers, media_type)
+    if range_header:
+        # If-Range didn't match: send the whole representation
+        with open(path, "rb") as f:
+            return Response(f.read(), headers=headers, media_type=media_type)
+    return FileResponse(path, headers=headers, media_type=media_type)
+
+@router.get("/images/{path:path}", name="images")
+def serve_image(path: str, request: Request, w: Optional[int] = None, format: Optional[str] = None):
+    """
+    Serve an image from IMAGES_DIR, optionally as a width-bucketed thumbnail
+    (?w=) and/or WebP (?format=webp, or negotiated from Accept). Variants are
+    rendered on first request and cached on disk by source hash. Responses
+    carry strong ETags, support If-None-Match and single byte ranges.
+    """
+    source = _resolve_source(path)
+    digest = source_hash(source)
+    width = bucket_width(w)
+    webp = wants_webp(request, format)
+    if not has_pillow():
+        width, webp = None, False
+
+    ext = ".webp" if webp else os.path.splitext(source)[1].lower()
+    variant = f"{width or 'orig'}{'-webp' if webp else ''}"
+    etag = f'"{digest[:32]}-{variant}"'
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag, vary=format is None))
+
+    if width is None and not webp:
+        target = source
+    else:
+        target = os.path.join(VARIANT_CACHE_DIR, digest[:2], f"{digest}-{variant}{ext}")
+        hit = os.path.exists(target)
+        record_cache("image_variant", hit)
+        if not hit:
+            try:
+                render_variant(source, target, width, "webp" if webp else "original")
+            except Exception as e:
+                logger.error("Failed to render %s variant of %s: %s", variant, path, e)
+                raise HTTPException(status_code=415, detail="Unsupported image")
+
+    return cached_file_response(request, target, etag, MEDIA_TYPES.get(ext, "application/octet-stream"), vary=format is None)
@@ -1,19 +1,16 @@
 import os
 import json
 import logging
-import requests
-from serpapi.google_search import GoogleSearch
-from dotenv import load_dotenv
 from typing import Dict, List, Any
 import random
 import re
+from itemSearch import resolve_items
+from metrics import STAGE_LATENCY, record_fallback
+from sharedCache import CACHE
+from upstream import model_reply_has, run_model
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
 def get_random_items(items: List[Dict[str, str]], count: int = 4) -> List[Dict[str, str]]:
     """
     Randomly select 'count' number of items from the given list.
@@ -390,6 +387,26 @@ def detect_category_from_filename(filename: str) -> str:
     # If no category is detected, return 'numbered' as default
     return 'numbered'
 
+class FallbackItems(dict):
+    """
+    The hardcoded items response. A plain dict to callers, but a fresh one
+    per call, so it is marked by type rather than by identity like the
+    other stages' HARDCODED_* answers.
+    """
+
+def fallback_items(reason: str) -> dict:
+    """
+    Build the hardcoded response: a random sample from each category.
+    """
+    record_fallback("items", reason)
+    random_items = FallbackItems()
+    for category, data in HARDCODED_ITEMS.items():
+        random_items[category] = {
+            "items": get_random_items(data["items"])
+        }
+    return random_items
+
+@STAGE_LATENCY.timed(stage="items")
 def generateItems(userProfile: dict) -> dict:
     """
     Generate clothing items based on user profile using Cloudflare Workers AI
@@ -401,20 +418,12 @@ def generateItems(userProfile: dict) -> dict:
         
         if not cloudflare_token or not cloudflare_account_id:
             logger.warning("Missing Cloudflare credentials, returning hardcoded items")
-            # Return random items from each category
-            random_items = {}
-            for category, data in HARDCODED_ITEMS.items():
-                random_items[category] = {
-                    "items": get_random_items(data["items"])
-                }
-            return random_items
+            return fallback_items("missing_credentials")
 
-        # Prepare the API request
-        url = f"https://api.cloudflare.com/client/v4/accounts/{cloudflare_account_id}/ai/run/@cf/meta/llama-2-7b-chat-int8"
-        headers = {
-            "Authorization": f"Bearer {cloudflare_token}",
-            "Content-Type": "application/json"
-        }
+        # Another worker may already have generated items for these outfits
+        cached = CACHE.get_items(userProfile)
+        if cached is not None:
+            return cached
 
         # Create a system prompt for item generation
         system_prompt = """You are a fashion expert. Generate a list of 5 clothing items that match the user's style profile.
@@ -424,64 +433,40 @@ def generateItems(userProfile: dict) -> dict:
         Format the response as a JSON object with an 'items' array containing the items."""
 
         # Prepare the data for the API request
-        data = {
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Generate items for this profile: {json.dumps(userProfile)}"}
-            ]
-        }
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Generate items for this profile: {json.dumps(userProfile)}"}
+        ]
 
         # Make the API request
-        response = requests.post(url, headers=headers, json=data)
+        response = run_model("items", cloudflare_account_id, cloudflare_token, messages, validate=model_reply_has("items"))
         response.raise_for_status()
         
         # Parse the response
         result = response.json()
-        logger.info(f"Cloudflare API Response: {json.dumps(result, indent=2)}")
+        logger.debug("Cloudflare API Response: %s", result)
         
         if not result.get("success", False):
-            logger.error(f"Cloudflare API error: {result.get('errors', 'Unknown error')}")
-            # Return random items from each category
-            random_items = {}
-            for category, data in HARDCODED_ITEMS.items():
-                random_items[category] = {
-                    "items": get_random_items(data["items"])
-                }
-            return random_items
+            logger.error("Cloudflare API error: %s", result.get('errors', 'Unknown error'))
+            return fallback_items("upstream_unsuccessful")
             
         # Extract the generated text
         generated_text = result.get("result", {}).get("response", "")
-        logger.info(f"Generated text: {generated_text}")
+        logger.debug("Generated text: %s", generated_text)
         
         # Try to parse the generated text as JSON
         try:
             items = json.loads(generated_text)
             if not isinstance(items, dict) or "items" not in items:
                 logger.error("Invalid response format: missing 'items' key")
-                # Return random items from each category
-                random_items = {}
-                for category, data in HARDCODED_ITEMS.items():
-                    random_items[category] = {
-                        "items": get_random_items(data["items"])
-                    }
-                return random_items
+                return fallback_items("invalid_format")
+            items = resolve_items(items)
+            CACHE.set_items(userProfile, items)
             return items
         except json.JSONDecodeError:
             logger.error("Failed to parse generated text as JSON")
-            # Return random items from each category
-            random_items = {}
-            for category, data in HARDCODED_ITEMS.items():
-                random_items[category] = {
-                    "items": get_random_items(data["items"])
-                }
-            return random_items
+            return fallback_items("unparseable_response")
             
     except Exception as e:
-        logger.error(f"Error generating items: {str(e)}")
-        # Return random items from each category
-        random_items = {}
-        for category, data in HARDCODED_ITEMS.items():
-            random_items[category] = {
-                "items": get_random_items(data["items"])
-            }
-        return random_items
+        logger.error("Error generating items: %s", e)
+        return fallback_items("upstream_error")
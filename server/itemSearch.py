@@ -0,0 +1,263 @@
+import os
+import re
+import json
+import time
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+from db import SQLitePool
+from metrics import Counter, Histogram, record_cache
+from rateLimit import TokenBucket
+from startup import load_env_once
+from upstream import get_session
+
+logger = logging.getLogger(__name__)
+
+load_env_once()
+
+SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
+# Overridable so tests and benchmarks can point at a local stand-in
+SERPAPI_BASE_URL = os.getenv("SERPAPI_BASE_URL", "https://serpapi.com").rstrip("/")
+SERPAPI_ENGINE = os.getenv("SERPAPI_ENGINE", "google_shopping")
+SERPAPI_TIMEOUT = float(os.getenv("SERPAPI_TIMEOUT", "10"))
+SERPAPI_RPS = float(os.getenv("SERPAPI_RPS", "5"))
+SERPAPI_BURST = float(os.getenv("SERPAPI_BURST", "10"))
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))
+# How long a lookup may wait for the rate limiter before giving up on that item
+SEARCH_MAX_WAIT = float(os.getenv("SEARCH_MAX_WAIT", "5"))
+# Overall budget for resolving one response's items
+SEARCH_RESOLVE_TIMEOUT = float(os.getenv("SEARCH_RESOLVE_TIMEOUT", "15"))
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "data/search_cache.db")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(7 * 24 * 3600)))
+# Queries with no results are retried sooner
+SEARCH_NEGATIVE_TTL = float(os.getenv("SEARCH_NEGATIVE_TTL", "3600"))
+# Expired rows are deleted on write, at most this often per worker
+SEARCH_PURGE_INTERVAL = float(os.getenv("SEARCH_PURGE_INTERVAL", "600"))
+
+SEARCHES = Counter("outfitsync_item_searches_total", "Shopping searches sent to SerpAPI by outcome", ("outcome",))
+SEARCH_LATENCY = Histogram("outfitsync_item_search_duration_seconds", "SerpAPI round-trip time")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_cache (
+    query TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS search_cache_expires ON search_cache (expires_at);
+"""
+
+def _init_db(conn) -> None:
+    conn.executescript(_SCHEMA)
+
+class SearchCache:
+    """Query -> first shopping result (or {} for none), with a TTL, in SQLite."""
+
+    def __init__(self, path: str = SEARCH_CACHE_PATH):
+        self.pool = SQLitePool(path, size=4, init=_init_db)
+        self._last_purge = 0.0
+
+    def get(self, query: str) -> Optional[Dict[str, Any]]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT result FROM search_cache WHERE query = ? AND expires_at > ?", (query, time.time())
+            ).fetchone()
+        return json.loads(row["result"]) if row is not None else None
+
+    def set(self, query: str, result: Dict[str, Any], ttl: float) -> None:
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO search_cache (query, result, expires_at) VALUES (?, ?, ?)",
+                (query, json.dumps(result), time.time() + ttl),
+            )
+        self._maybe_purge()
+
+    def _maybe_purge(self) -> None:
+        now = time.monotonic()
+        if now - self._last_purge < SEARCH_PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        try:
+            self.purge_expired()
+        except sqlite3.Error as e:
+            # Usually another worker holding the write lock; the next interval catches up
+            logger.debug("Search cache purge skipped: %s", e)
+
+    def purge_expired(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute("DELETE FROM search_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+
+_WORDS = re.compile(r"[a-z0-9]+")
+
+def query_for(item: Dict[str, Any]) -> Optional[str]:
+    """
+    Shopping query for an item: its description, lowercased and stripped of
+    punctuation so trivially different phrasings from different users share
+    one cache entry and one search.
+    """
+    text = item.get("title") or item.get("description")
+    if not isinstance(text, str):
+        return None
+    query = " ".join(_WORDS.findall(text.lower()))[:120].strip()
+    return query or None
+
+def _client_class():
+    # Imported lazily: the server runs without the serpapi package installed
+    from serpapi import GoogleSearch
+
+    class PooledGoogleSearch(GoogleSearch):
+        """GoogleSearch over the shared keep-alive session, with a real timeout."""
+
+        BACKEND = SERPAPI_BASE_URL
+
+        def get_response(self, path="/search"):
+            url, params = self.construct_url(path)
+            response = get_session().get(url, params=params, timeout=SERPAPI_TIMEOUT)
+            response.raise_for_status()
+            return response
+
+    return PooledGoogleSearch
+
+def _first_result(data: Dict[str, Any]) -> Dict[str, Any]:
+    for result in data.get("shopping_results") or []:
+        image = result.get("thumbnail") or result.get("image")
+        link = result.get("product_link") or result.get("link")
+        if image and link:
+            return {
+                "title": result.get("title"),
+                "link": link,
+                "thumbnail": image,
+                "price": result.get("price"),
+                "source": result.get("source"),
+            }
+    return {}
+
+class ItemResolver:
+    """
+    Resolves item descriptions to real products. Lookups run concurrently on
+    a small thread pool under a global token bucket; identical queries in
+    flight at the same time share one search, and results (including "no
+    result") are cached with a TTL so each query is paid for once.
+    """
+
+    def __init__(self, api_key: Optional[str] = SERPAPI_API_KEY, cache: Optional[SearchCache] = None,
+                 rate: float = SERPAPI_RPS, burst: float = SERPAPI_BURST, workers: int = SEARCH_WORKERS):
+        self.api_key = api_key
+        self.cache = cache
+        self._bucket = TokenBucket(rate, burst)
+        self._bucket_lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._in_flight_lock = threading.Lock()
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._client = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key)
+
+    def _start(self) -> None:
+        if self._executor is None:
+            with self._in_flight_lock:
+                if self._executor is None:
+                    if self.cache is None:
+                        self.cache = SearchCache()
+                    self._client = _client_class()
+                    self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="item-search")
+
+    def _wait_for_token(self) -> bool:
+        deadline = time.monotonic() + SEARCH_MAX_WAIT
+        while True:
+            with self._bucket_lock:
+                allowed, retry_after = self._bucket.take()
+            if allowed:
+                return True
+            if time.monotonic() + retry_after > deadline:
+                return False
+            time.sleep(retry_after)
+
+    def _search(self, query: str) -> Dict[str, Any]:
+        if not self._wait_for_token():
+            SEARCHES.inc(outcome="rate_limited")
+            return {}
+        params = {"engine": SERPAPI_ENGINE, "q": query, "api_key": self.api_key, "num": 5}
+        try:
+            with SEARCH_LATENCY.time():
+                data = self._client(params).get_dict()
+        except Exception as e:
+            SEARCHES.inc(outcome="error")
+            # Not str(e): request errors embed the URL, and with it the API key
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            logger.warning("Item search failed for %r: %s %s", query, type(e).__name__, status or "")
+            return {}
+        result = _first_result(data)
+        SEARCHES.inc(outcome="ok" if result else "empty")
+        self.cache.set(query, result, SEARCH_CACHE_TTL if result else SEARCH_NEGATIVE_TTL)
+        return result
+
+    def lookup(self, query: str) -> Future:
+        """Future for `query`'s product: from cache, an identical search in flight, or a new search."""
+        self._start()
+        cached = self.cache.get(query)
+        record_cache("item_search", cached is not None)
+        if cached is not None:
+            future: Future = Future()
+            future.set_result(cached)
+            return future
+        with self._in_flight_lock:
+            future = self._in_flight.get(query)
+            if future is None:
+                future = self._executor.submit(self._search, query)
+                self._in_flight[query] = future
+                future.add_done_callback(lambda _, q=query: self._forget(q))
+        return future
+
+    def _forget(self, query: str) -> None:
+        with self._in_flight_lock:
+            self._in_flight.pop(query, None)
+
+    def resolve(self, items: List[Dict[str, Any]], timeout: float = SEARCH_RESOLVE_TIMEOUT) -> List[Dict[str, Any]]:
+        """
+        Return copies of `items` with a real product attached where one was
+        found: `url` becomes the product image, plus `link`, `title`, `price`
+        and `source`. Items without a match (or not resolved within `timeout`)
+        are returned unchanged.
+        """
+        if not self.enabled:
+            return items
+        futures = []
+        for item in items:
+            query = query_for(item) if isinstance(item, dict) else None
+            futures.append(self.lookup(query) if query else None)
+        wait([f for f in futures if f is not None], timeout=timeout)
+
+        resolved = []
+        for item, future in zip(items, futures):
+            product = {}
+            if future is not None and future.done():
+                try:
+                    product = future.result(timeout=0)
+                except Exception:
+                    product = {}
+            if not product:
+                resolved.append(item)
+                continue
+            resolved.append(dict(
+                item,
+                url=product["thumbnail"],
+                link=product["link"],
+                title=product.get("title") or item.get("title"),
+                price=product.get("price"),
+                source=product.get("source"),
+            ))
+        return resolved
+
+RESOLVER = ItemResolver()
+
+def resolve_items(items: Dict[str, Any]) -> Dict[str, Any]:
+    """Attach real products to a generated {"items": [...]} response when SerpAPI is configured."""
+    if not RESOLVER.enabled or not isinstance(items.get("items"), list):
+        return items
+    return dict(items, items=RESOLVER.resolve(items["items"]))
@@ -0,0 +1,363 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from db import SQLitePool
+from metrics import Gauge, Histogram
+from pipeline import run_pipeline, used_fallback
+from scheduler import BATCH, set_priority
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "256"))
+JOB_MAX_STORED = int(os.getenv("JOB_MAX_STORED", "1024"))
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+JOB_DIR = os.getenv("JOB_DIR", "img/jobs")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "data/jobs.db")
+# How often a long-poll for a job running in another worker re-reads the store
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.25"))
+# An unfinished job older than this (queued by `created`, running by
+# `started`) is presumed lost with its worker and may be claimed again
+JOB_LEASE = float(os.getenv("JOB_LEASE", "600"))
+JOB_PURGE_INTERVAL = float(os.getenv("JOB_PURGE_INTERVAL", "60"))
+
+JOB_QUEUE_DEPTH = Gauge("outfitsync_job_queue_depth", "Jobs waiting for a worker")
+JOB_DURATION = Histogram("outfitsync_job_duration_seconds", "Time from job start to finish", ("status",))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+class JobQueueFull(Exception):
+    """Raised when no more jobs can be accepted right now."""
+
+@dataclass
+class Job:
+    id: str
+    key: str
+    owner: str
+    image_dir: str
+    image_files: List[str]
+    status: str = QUEUED
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "Job":
+        """A read-only snapshot of a job stored by any worker."""
+        return cls(
+            id=row["id"], key=row["key"], owner=row["owner"], image_dir="", image_files=[],
+            status=row["status"], created=row["created"], started=row["started"], finished=row["finished"],
+            result=json.loads(row["result"]) if row["result"] is not None else None, error=row["error"],
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.status == SUCCEEDED:
+            data["result"] = self.result
+        if self.status == FAILED:
+            data["error"] = self.error
+            if self.result is not None:
+                # The hardcoded fallback, still useful to show while retrying
+                data["result"] = self.result
+        return data
+
+def job_key(owner: str, images: List[bytes], idempotency_key: Optional[str] = None) -> str:
+    """
+    Identify a submission so a retried upload maps to the job already
+    running or finished for it. Clients may pass their own Idempotency-Key.
+    """
+    digest = hashlib.sha256(owner.encode("utf-8"))
+    if idempotency_key:
+        digest.update(b"key:" + idempotency_key.encode("utf-8"))
+    else:
+        for content in images:
+            digest.update(hashlib.sha256(content).digest())
+    return digest.hexdigest()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+"""
+
+def _init_db(conn) -> None:
+    conn.executescript(_SCHEMA)
+
+class JobStore:
+    """
+    Job records in SQLite, so a job queued on one worker process can be
+    polled through any of them.
+    """
+
+    def __init__(self, path: str = JOB_DB_PATH):
+        self.pool = SQLitePool(path, size=4, init=_init_db)
+
+    # Rows are returned as dicts; Job.from_row runs on the event loop, since
+    # Job holds an asyncio.Event and these methods run in worker threads.
+
+    def claim(self, job: Job, ttl: float, lease: float = JOB_LEASE) -> Optional[Dict[str, Any]]:
+        """
+        Record `job` unless a live job exists for its key: one queued or
+        running within `lease`, or succeeded less than `ttl` seconds ago.
+        Atomic across workers. Returns the existing job's row, or None if
+        `job` was recorded.
+        """
+        now = time.time()
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO jobs (id, key, owner, status, created) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    id = excluded.id, owner = excluded.owner, status = excluded.status,
+                    created = excluded.created, started = NULL, finished = NULL, result = NULL, error = NULL
+                WHERE jobs.status = ? OR jobs.finished < ?
+                    OR (jobs.finished IS NULL AND COALESCE(jobs.started, jobs.created) < ?)
+                """,
+                (job.id, job.key, job.owner, job.status, job.created, FAILED, now - ttl, now - lease),
+            )
+            if cursor.rowcount == 1:
+                return None
+            row = conn.execute("SELECT * FROM jobs WHERE key = ?", (job.key,)).fetchone()
+        return dict(row)
+
+    def update(self, job: Job) -> None:
+        result = json.dumps(job.result) if job.result is not None else None
+        with self.pool.connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, started = ?, finished = ?, result = ?, error = ? WHERE id = ?",
+                (job.status, job.started, job.finished, result, job.error, job.id),
+            )
+
+    def get(self, job_id: str, ttl: float) -> Optional[Dict[str, Any]]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE id = ? AND (finished IS NULL OR finished >= ?)",
+                (job_id, time.time() - ttl),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def purge(self, ttl: float, lease: float = JOB_LEASE) -> int:
+        """Delete jobs finished over `ttl` ago and unfinished ones abandoned past `lease`."""
+        now = time.time()
+        with self.pool.connection() as conn:
+            return conn.execute(
+                "DELETE FROM jobs WHERE finished < ? OR (finished IS NULL AND COALESCE(started, created) < ?)",
+                (now - ttl, now - lease),
+            ).rowcount
+
+class JobManager:
+    """
+    Runs the profile -> outfits -> items pipeline for submitted uploads on a
+    fixed pool of asyncio workers, each handing the blocking work to a
+    thread. A job runs in the process that accepted it, but its record
+    lives in the shared JobStore, so under `uvicorn --workers N` any worker
+    can report on it. Finished jobs are kept for JOB_TTL seconds; each
+    process tracks at most JOB_MAX_STORED of its own, oldest evicted first.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE,
+                 max_stored: int = JOB_MAX_STORED, ttl: float = JOB_TTL, store: Optional[JobStore] = None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_stored = max_stored
+        self.ttl = ttl
+        self.store = store or JobStore()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._last_purge = 0.0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Queued or interrupted jobs die with this process; say so, rather
+        # than leave other workers reporting them as queued until the lease ends
+        for job in list(self._jobs.values()):
+            if not job.is_finished:
+                job.status, job.error, job.finished = FAILED, "server restarted", time.time()
+                shutil.rmtree(job.image_dir, ignore_errors=True)
+                await self._record(job)
+                job.done.set()
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        await self._evict()
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        row = await self.store.pool.run(self.store.get, job_id, self.ttl)
+        return Job.from_row(row) if row is not None else None
+
+    async def submit(self, owner: str, key: str, images: List[bytes], suffixes: List[str]) -> Job:
+        """
+        Queue a job for `images`, or return the existing job for `key` if
+        it is still queued, running, or finished successfully, in this
+        worker or any other.
+        """
+        await self._evict()
+        if self._queue is None or self._queue.full():
+            raise JobQueueFull("Job queue is full")
+        if len(self._jobs) >= self.max_stored and not self._evict_one_finished():
+            raise JobQueueFull("Too many jobs in flight")
+
+        job_id = uuid.uuid4().hex
+        job = Job(id=job_id, key=key, owner=owner, image_dir=os.path.join(JOB_DIR, job_id), image_files=[])
+        existing = await self.store.pool.run(self.store.claim, job, self.ttl)
+        if existing is not None:
+            return self._jobs.get(existing["id"]) or Job.from_row(existing)
+
+        try:
+            os.makedirs(job.image_dir, exist_ok=True)
+            for index, (content, suffix) in enumerate(zip(images, suffixes)):
+                # Index-based names keep client-supplied filenames off the disk path
+                path = os.path.join(job.image_dir, f"{index}{suffix}")
+                with open(path, "wb") as f:
+                    f.write(content)
+                job.image_files.append(path)
+        except OSError as e:
+            # Don't leave a claimed key stuck in "queued"
+            job.status, job.error, job.finished = FAILED, str(e), time.time()
+            await self._record(job)
+            shutil.rmtree(job.image_dir, ignore_errors=True)
+            raise
+        if self._queue.full():
+            # Filled up while the claim was being written
+            job.status, job.error, job.finished = FAILED, "Job queue is full", time.time()
+            await self._record(job)
+            shutil.rmtree(job.image_dir, ignore_errors=True)
+            raise JobQueueFull("Job queue is full")
+
+        self._jobs[job_id] = job
+        self._queue.put_nowait(job)
+        JOB_QUEUE_DEPTH.inc()
+        return job
+
+    async def wait(self, job: Job, timeout: float) -> Job:
+        """Long-poll: return once `job` finishes or `timeout` seconds pass."""
+        if job.is_finished or timeout <= 0:
+            return job
+        if self._jobs.get(job.id) is job:
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return job
+        # Running in another worker: re-read its record until it finishes
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(JOB_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+            row = await self.store.pool.run(self.store.get, job.id, self.ttl)
+            if row is None:
+                break
+            job = Job.from_row(row)
+            if job.is_finished:
+                break
+        return job
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await self._queue.get()
+            JOB_QUEUE_DEPTH.dec()
+            job.status = RUNNING
+            job.started = time.time()
+            await self._record(job)
+            # Background work yields upstream slots to anyone waiting live
+            set_priority(BATCH, job.owner)
+            try:
+                job.result = await asyncio.to_thread(run_pipeline, job.image_files)
+                if used_fallback(job.result):
+                    # Failed so the key isn't held for JOB_TTL: resubmitting
+                    # once the upstream recovers runs the pipeline again
+                    job.error = "upstream unavailable; result is the default fallback"
+                    job.status = FAILED
+                else:
+                    job.status = SUCCEEDED
+            except Exception as e:
+                logger.exception("Job %s failed: %s", job.id, e)
+                job.error = str(e)
+                job.status = FAILED
+            finally:
+                job.finished = time.time()
+                JOB_DURATION.observe(job.finished - job.started, status=job.status)
+                shutil.rmtree(job.image_dir, ignore_errors=True)
+                await self._record(job)
+                job.done.set()
+                self._queue.task_done()
+
+    async def _record(self, job: Job) -> None:
+        try:
+            await self.store.pool.run(self.store.update, job)
+        except Exception as e:
+            # Local pollers still see the job; other workers see it stale
+            logger.error("Failed to record job %s: %s", job.id, e)
+
+    def _forget(self, job_id: str) -> None:
+        self._jobs.pop(job_id)
+
+    async def _evict(self) -> None:
+        cutoff = time.time() - self.ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.is_finished and job.finished < cutoff
+        ]
+        for job_id in expired:
+            self._forget(job_id)
+        # The store is shared, so purge on an interval rather than only when
+        # this worker's own jobs expire
+        now = time.monotonic()
+        if now - self._last_purge >= JOB_PURGE_INTERVAL:
+            self._last_purge = now
+            try:
+                await self.store.pool.run(self.store.purge, self.ttl)
+            except Exception as e:
+                logger.warning("Failed to purge old jobs: %s", e)
+
+    def _evict_one_finished(self) -> bool:
+        for job_id, job in self._jobs.items():
+            if job.is_finished:
+                self._forget(job_id)
+                return True
+        return False
+
+JOBS = JobManager()
@@ -0,0 +1,138 @@
+import os
+import re
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
+from typing import Any, Dict, Optional, Tuple
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_FIELD = int(os.getenv("LOG_MAX_FIELD", "256"))
+LOG_MAX_MESSAGE = int(os.getenv("LOG_MAX_MESSAGE", "4096"))
+
+# Pass as `extra=HIGH_VOLUME` on per-request lines to keep one in N of them
+HIGH_VOLUME = {"sample_every": int(os.getenv("LOG_SAMPLE_EVERY", "100"))}
+
+# Keys whose values are never written out, wherever they appear in a logged dict
+REDACTED_KEYS = {"authorization", "access_token", "api_token", "hashed_password", "password", "token"}
+
+_DATA_URI = re.compile(r"data:([\w/+.-]+);base64,[A-Za-z0-9+/=]+")
+_BEARER = re.compile(r"(Bearer\s+)[A-Za-z0-9\-._~+/]+=*", re.IGNORECASE)
+_JWT = re.compile(r"eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+dropped_records = 0
+
+def _redact_text(text: str) -> str:
+    text = _DATA_URI.sub(lambda m: f"data:{m.group(1)};base64,<{len(m.group(0))} chars>", text)
+    text = _BEARER.sub(r"\1<redacted>", text)
+    return _JWT.sub("<jwt>", text)
+
+def _truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...<{len(text) - limit} more chars>"
+
+def _scrub(value: Any, depth: int = 0) -> Any:
+    """
+    Return a copy of `value` that is safe and small enough to log: secrets
+    are masked, base64 payloads collapsed and long strings truncated.
+    """
+    if isinstance(value, str):
+        return _truncate(_redact_text(value), LOG_MAX_FIELD)
+    if depth > 4:
+        return "<...>"
+    if isinstance(value, dict):
+        return {
+            k: "<redacted>" if str(k).lower() in REDACTED_KEYS else _scrub(v, depth + 1)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        items = [_scrub(v, depth + 1) for v in value[:20]]
+        if len(value) > 20:
+            items.append(f"<{len(value) - 20} more>")
+        return items
+    return value
+
+class RedactingFormatter(logging.Formatter):
+    """
+    Formats records on the listener thread, scrubbing each argument before
+    it is interpolated and capping the final message length.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = _scrub(record.args)
+            else:
+                record.args = tuple(_scrub(a) for a in record.args)
+        record.msg = _redact_text(str(record.msg))
+        message = super().format(record)
+        return _truncate(message, LOG_MAX_MESSAGE)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in N records for call sites that pass `extra={"sample_every": N}`.
+    Counting is per call site, so one noisy line doesn't hide another.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._counts: Dict[Tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        every = getattr(record, "sample_every", None)
+        if not every or every <= 1:
+            return True
+        key = (record.pathname, record.lineno)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        return count % every == 0
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that leaves formatting to the listener thread and drops
+    records instead of blocking when the queue is full.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # Tracebacks can't cross to another thread safely; render now.
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+def configure_logging(level: str = LOG_LEVEL) -> None:
+    """
+    Route all logging through a bounded queue to a background thread that
+    does the formatting and I/O. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(RedactingFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    handler = _DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
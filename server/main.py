@@ -1,42 +1,114 @@
+import startup
 from typing import Union, Dict, Any, List
 import os
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from profileGenerator import generateProfile
+from profileGenerator import generateProfile, HARDCODED_PROFILE
 from outfitGenerator import generateOutfits, HARDCODED_OUTFITS
 from itemGenerator import generateItems, HARDCODED_ITEMS, get_random_items
+from pipeline import run_pipeline
+from imageIndex import DirectoryIndex
+from jobs import JOBS, JobQueueFull, job_key
 from auth import (
-    authenticate_user, create_access_token, verify_token,
-    USERS_DB, Token, User, ACCESS_TOKEN_EXPIRE_MINUTES
+    authenticate_user_async, start_session, end_session, verify_session_token,
+    get_public_user, USERS_DB, GUEST_USER, LoginBusyError,
+    Token, User
 )
-from datetime import timedelta
-from dotenv import load_dotenv
-from fastapi.responses import JSONResponse
-from serpapi.google_search import GoogleSearch
-import traceback
+from fastapi.responses import JSONResponse, Response
+import admission
+import scheduler
+import metrics
+import profiling
+import imageVariants
+import imageProxy
+import responseEncoding
+import refineSessions
+import asyncio
+import time
 import logging
 import json
 import re
+from logSetup import configure_logging, HIGH_VOLUME
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Load environment variables
-load_dotenv()
+startup.load_env_once()
+startup.mark("imports")
 
 # OAuth2 scheme for token authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 app = FastAPI()
 
-# Mount the static files directory
-app.mount("/images", StaticFiles(directory="public/images"), name="images")
+# Serve /images with on-demand thumbnails, WebP variants and long-lived caching
+app.include_router(imageVariants.router)
+# Third-party item/outfit images are fetched once and served from a local cache
+app.include_router(imageProxy.router)
+# Stateful refinement over a WebSocket: profile sent once, deltas afterwards
+app.include_router(refineSessions.router)
 
-# Add CORS middleware
+_static_routes = None
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Label by the route template (e.g. /items/{item_id}) to bound cardinality;
+    # the route is only known once routing has run inside call_next, so the
+    # in-flight gauge only names routes without path parameters.
+    global _static_routes
+    if _static_routes is None:
+        _static_routes = {r.path for r in app.routes if "{" not in getattr(r, "path", "{")}
+    method = request.method
+    path = request.url.path
+    in_flight_route = path if path in _static_routes else "other"
+    started = time.perf_counter()
+    status_code = 500
+    with metrics.HTTP_IN_FLIGHT.track(method=method, route=in_flight_route):
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            route = request.scope.get("route")
+            metrics.HTTP_LATENCY.observe(
+                time.perf_counter() - started,
+                method=method,
+                route=getattr(route, "path", "unmatched"),
+                status=str(status_code),
+            )
+
+@app.middleware("http")
+async def assign_upstream_priority(request: Request, call_next):
+    # Tag the request for the upstream scheduler: signed-in users outrank
+    # guests. The interactive class is the server's call (refinement
+    # sockets); clients may only lower themselves, with X-Priority:
+    # background for work nobody is waiting on. The token check is served
+    # from cache.
+    background = request.headers.get("x-priority", "").lower() == "background"
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token and token != "guest":
+        token_data = await verify_session_token(USERS_DB, token)
+        if token_data is not None:
+            scheduler.set_priority(scheduler.BATCH if background else scheduler.AUTHENTICATED, token_data.email)
+            return await call_next(request)
+    scheduler.set_priority(
+        scheduler.BATCH if background else scheduler.GUEST,
+        request.client.host if request.client else "anonymous",
+    )
+    return await call_next(request)
+
+# Per-client rate limits and per-route concurrency caps for generator routes
+admission.install(app)
+
+# Opt-in per-request profiling; a no-op unless PROFILING_TOKEN is set
+profiling.install(app)
+
+# Add CORS middleware last so it is outermost: shed and fallback responses
+# from the middleware above need the CORS headers too
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
@@ -45,6 +117,31 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+startup.mark("app")
+
+@app.on_event("startup")
+async def start_warmups():
+    # Let uvicorn start accepting connections right away; one-time work such
+    # as seeding users and forking the bcrypt pool happens in the background.
+    startup.mark("serving")
+    app.state.warmup_task = asyncio.create_task(startup.run_warmups())
+
+@app.on_event("startup")
+async def start_job_workers():
+    JOBS.start()
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await JOBS.stop()
+
+@app.get("/startup")
+def startup_report():
+    return startup.report()
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render_all(), media_type=metrics.CONTENT_TYPE)
+
 class UserInput(BaseModel):
     text: str
 
@@ -57,31 +154,42 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     
     # Allow guest access
     if token == "guest":
-        return User(email="guest@example.com", full_name="Guest User")
+        return GUEST_USER
     
-    token_data = verify_token(token)
+    token_data = await verify_session_token(USERS_DB, token)
     if token_data is None:
         raise credentials_exception
-    user = USERS_DB.get(token_data.email)
+    user = await get_public_user(USERS_DB, token_data.email)
     if user is None:
         raise credentials_exception
-    return User(email=user["email"], full_name=user["full_name"])
+    return user
 
 @app.post("/login", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(USERS_DB, form_data.username, form_data.password)
+    await startup.ready("users")
+    try:
+        user = await authenticate_user_async(USERS_DB, form_data.username, form_data.password)
+    except LoginBusyError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts, try again shortly",
+            headers={"Retry-After": "1"},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
+    access_token = await start_session(USERS_DB, user.email)
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(token: str = Depends(oauth2_scheme)):
+    if token != "guest":
+        await end_session(USERS_DB, token)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
@@ -90,40 +198,35 @@ def read_root():
 def read_item(item_id: int, q: Union[str, None] = None):
     return {"item_id": item_id, "q": q}
 
-@app.get("/generate")
-def generate_img():
-    def get_image_files():
-        import os
+# Index of ./img so GET /generate only re-runs the pipeline when images change
+IMAGE_INDEX = DirectoryIndex("./img", (".jpg", ".jpeg", ".png"))
 
-        img_dir = "./img"
-        return [
-            os.path.join(img_dir, f)
-            for f in os.listdir(img_dir)
-            if f.endswith((".jpg", ".jpeg", ".png"))
-        ]
+def reply(request: Request, payload: Any, **kwargs) -> Response:
+    """Point a payload's third-party image URLs at /img-proxy and encode it as the client negotiated."""
+    payload = imageProxy.rewrite_urls(payload, imageProxy.base_url_for(request))
+    return responseEncoding.respond(request, payload, **kwargs)
 
-    image_files = get_image_files()
-    profile = generateProfile(image_files)
-
-    # Generate outfit recommendations
-    outfits = generateOutfits(profile)
-
-    items = generateItems(outfits)
-
-    return JSONResponse(
-        {"profile": profile, "outfit_recommendations": outfits, "items": items}
+def reply_static(request: Request, key: str, build, **kwargs) -> Response:
+    """reply() for payloads fixed per `key`, such as the hardcoded fallbacks; encoded once."""
+    base_url = imageProxy.base_url_for(request)
+    return responseEncoding.respond_static(
+        request, (key, base_url), lambda: imageProxy.rewrite_urls(build(), base_url), **kwargs
     )
 
+@app.get("/generate")
+def generate_img(request: Request):
+    return reply(request, IMAGE_INDEX.get_or_compute(run_pipeline))
+
 @app.get("/generate-outfits")
-def generate_outfits(profile: str):
+def generate_outfits(profile: str, request: Request):
     try:
         # Parse the profile string into a dictionary
         profile_data = json.loads(profile)
         
         # Generate outfit recommendations
-        logger.info("Generating outfits...")
+        logger.info("Generating outfits...", extra=HIGH_VOLUME)
         outfits = generateOutfits(profile_data)
-        logger.info(f"Generated outfits: {outfits}")
+        logger.debug("Generated outfits: %s", outfits)
         
         # Ensure we have a valid response structure
         response_data = {
@@ -131,28 +234,25 @@ def generate_outfits(profile: str):
             "status": "success"
         }
         
-        return JSONResponse(content=response_data)
+        if outfits is HARDCODED_OUTFITS:
+            return reply_static(request, "generate-outfits:fallback", lambda: response_data)
+        return reply(request, response_data)
     except json.JSONDecodeError as e:
-        logger.error(f"Error parsing profile JSON: {str(e)}")
+        logger.error("Error parsing profile JSON: %s", e)
         # Return hardcoded outfits if JSON parsing fails
-        return JSONResponse(
-            content={
-                "outfit_recommendations": HARDCODED_OUTFITS["outfit_recommendations"],
-                "status": "error",
-                "message": "Invalid profile format, using default outfits"
-            }
-        )
+        return reply_static(request, "generate-outfits:invalid-profile", lambda: {
+            "outfit_recommendations": HARDCODED_OUTFITS["outfit_recommendations"],
+            "status": "error",
+            "message": "Invalid profile format, using default outfits"
+        })
     except Exception as e:
-        logger.error(f"Error generating outfits: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error generating outfits: %s", e)
         # Return hardcoded outfits if any other error occurs
-        return JSONResponse(
-            content={
-                "outfit_recommendations": HARDCODED_OUTFITS["outfit_recommendations"],
-                "status": "error",
-                "message": str(e)
-            }
-    )
+        return reply(request, {
+            "outfit_recommendations": HARDCODED_OUTFITS["outfit_recommendations"],
+            "status": "error",
+            "message": str(e)
+        })
 
 def detect_category_from_filename(filename: str) -> str:
     """
@@ -178,6 +278,7 @@ def detect_category_from_filename(filename: str) -> str:
 
 @app.post("/generate")
 async def generate(
+    request: Request,
     images: list[UploadFile] = File(...),
     current_user: User = Depends(get_current_user)
 ):
@@ -216,15 +317,14 @@ async def generate(
                 if os.path.exists(file_path):
                     os.remove(file_path)
             
-            return JSONResponse({
+            return reply(request, {
                 "status": "success",
                 "categories": list(categories),
                 "items": category_items
             })
             
         except Exception as e:
-            logger.error(f"Error during generation: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error during generation: %s", e)
             # Clean up uploaded images in case of error
             for file_path in image_files:
                 if os.path.exists(file_path):
@@ -234,15 +334,52 @@ async def generate(
                 content={"error": str(e)}
             )
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Unexpected error: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
         )
 
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(
+    images: list[UploadFile] = File(...),
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Union[str, None] = Header(default=None),
+):
+    """
+    Queue the full profile/outfits/items pipeline for the uploaded images and
+    return at once. Poll GET /jobs/{job_id} for the result; resubmitting the
+    same images (or Idempotency-Key) returns the existing job.
+    """
+    contents = [await image.read() for image in images]
+    suffixes = [os.path.splitext(image.filename or "")[1].lower() or ".jpg" for image in images]
+    key = job_key(current_user.email, contents, idempotency_key)
+    try:
+        job = await JOBS.submit(current_user.email, key, contents, suffixes)
+    except JobQueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "5"},
+        )
+    return {"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    request: Request,
+    wait: float = Query(default=0, ge=0, le=30),
+    current_user: User = Depends(get_current_user),
+):
+    """Return a job's status, long-polling up to `wait` seconds for it to finish."""
+    job = await JOBS.get(job_id)
+    if job is None or job.owner != current_user.email:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    job = await JOBS.wait(job, wait)
+    return reply(request, job.to_dict())
+
 @app.get("/generate-items")
-def generate_items():
+def generate_items(request: Request):
     sampleOutfits = {
         "profile": {
             "Age": 20,
@@ -279,39 +416,45 @@ def generate_items():
         ],
         "items": [],
     }
-    return generateItems(sampleOutfits)
+    return reply(request, generateItems(sampleOutfits))
 
 @app.post("/generate-profile")
-async def create_profile(user_input: UserInput):
+async def create_profile(user_input: UserInput, request: Request):
     try:
-        logger.info(f"Received profile generation request with input: {user_input.text}")
-        profile = generateProfile(user_input.text)
-        logger.info(f"Generated profile: {profile}")
-        return profile
+        logger.info("Received profile generation request (%d chars)", len(user_input.text), extra=HIGH_VOLUME)
+        # Generators block on upstream slots, retries and item lookups; keep
+        # them off the event loop. to_thread carries the scheduler priority.
+        profile = await asyncio.to_thread(generateProfile, user_input.text)
+        logger.debug("Generated profile: %s", profile)
+        if profile is HARDCODED_PROFILE:
+            return reply_static(request, "hardcoded-profile", lambda: HARDCODED_PROFILE)
+        return reply(request, profile)
     except Exception as e:
-        logger.error(f"Error generating profile: {str(e)}")
+        logger.error("Error generating profile: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate-outfits")
-async def create_outfits(profile: Dict[str, Any]):
+async def create_outfits(profile: Dict[str, Any], request: Request):
     try:
-        logger.info(f"Received outfit generation request with profile: {profile}")
-        outfits = generateOutfits(profile)
-        logger.info(f"Generated outfits: {outfits}")
-        return outfits
+        logger.debug("Received outfit generation request with profile: %s", profile)
+        outfits = await asyncio.to_thread(generateOutfits, profile)
+        logger.debug("Generated outfits: %s", outfits)
+        if outfits is HARDCODED_OUTFITS:
+            return reply_static(request, "hardcoded-outfits", lambda: HARDCODED_OUTFITS)
+        return reply(request, outfits)
     except Exception as e:
-        logger.error(f"Error generating outfits: {str(e)}")
+        logger.error("Error generating outfits: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate-items")
-async def create_items(profile: Dict[str, Any]):
+async def create_items(profile: Dict[str, Any], request: Request):
     try:
-        logger.info(f"Received item generation request with profile: {profile}")
-        items = generateItems(profile)
-        logger.info(f"Generated items: {items}")
-        return items
+        logger.debug("Received item generation request with profile: %s", profile)
+        items = await asyncio.to_thread(generateItems, profile)
+        logger.debug("Generated items: %s", items)
+        return reply(request, items)
     except Exception as e:
-        logger.error(f"Error generating items: {str(e)}")
+        logger.error("Error generating items: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
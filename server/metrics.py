@@ -0,0 +1,240 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Prometheus text exposition format content type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_registry: List["_Metric"] = []
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    """
+    Base for metrics whose samples are kept in per-thread shards.
+
+    Each thread writes only to its own dict, so the hot path takes no lock;
+    a scrape copies and merges every shard. A shard outlives its thread, so
+    counts from finished threads are never lost.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+        _registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _snapshots(self) -> List[dict]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [shard.copy() for shard in shards]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1.0, **labels: str) -> None:
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0.0) + value
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        merged: Dict[Tuple[str, ...], float] = {}
+        for snapshot in self._snapshots():
+            for key, value in snapshot.items():
+                merged[key] = merged.get(key, 0.0) + value
+        return merged
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+            for key, value in sorted(self.values().items())
+        ]
+
+class Gauge(Counter):
+    """
+    A counter that can also go down. Increments and decrements may happen on
+    different threads; the merged sum is still correct. Gauges backed by a
+    callback are read at scrape time instead.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, description, labelnames)
+        self._callbacks: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def dec(self, value: float = 1.0, **labels: str) -> None:
+        self.inc(-value, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels: str) -> None:
+        self._callbacks[self._key(labels)] = fn
+
+    @contextmanager
+    def track(self, **labels: str) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        merged = super().values()
+        for key, fn in list(self._callbacks.items()):
+            try:
+                merged[key] = float(fn())
+            except Exception:
+                continue
+        return merged
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str) -> None:
+        shard = self._shard()
+        key = self._key(labels)
+        row = shard.get(key)
+        if row is None:
+            # one slot per bucket, then +Inf, then sum
+            row = [0.0] * (len(self.buckets) + 2)
+            shard[key] = row
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, **labels: str):
+        """Decorator form of `time`."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def values(self) -> Dict[Tuple[str, ...], List[float]]:
+        merged: Dict[Tuple[str, ...], List[float]] = {}
+        for snapshot in self._snapshots():
+            for key, row in snapshot.items():
+                row = list(row)
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = row
+                else:
+                    for i, value in enumerate(row):
+                        total[i] += value
+        return merged
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, row in sorted(self.values().items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            cumulative += row[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {row[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+def render_all() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+def record_fallback(stage: str, reason: str) -> None:
+    FALLBACKS.inc(stage=stage, reason=reason)
+
+HTTP_LATENCY = Histogram(
+    "outfitsync_http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ("method", "route", "status"),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "outfitsync_http_requests_in_flight",
+    "HTTP requests currently being handled",
+    ("method", "route"),
+)
+STAGE_LATENCY = Histogram(
+    "outfitsync_stage_duration_seconds",
+    "Time spent in each generator stage, including fallbacks",
+    ("stage",),
+)
+FALLBACKS = Counter(
+    "outfitsync_fallbacks_total",
+    "Generator calls answered with hardcoded data, by reason",
+    ("stage", "reason"),
+)
+UPSTREAM_REQUESTS = Counter(
+    "outfitsync_upstream_requests_total",
+    "Calls to Workers AI by stage and HTTP status (\"error\" if no response)",
+    ("stage", "status"),
+)
+UPSTREAM_LATENCY = Histogram(
+    "outfitsync_upstream_duration_seconds",
+    "Workers AI round-trip time",
+    ("stage",),
+)
+UPSTREAM_BYTES = Histogram(
+    "outfitsync_upstream_payload_bytes",
+    "Workers AI request and response body sizes",
+    ("stage", "direction"),
+    buckets=BYTES_BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    "outfitsync_cache_requests_total",
+    "Cache lookups by cache and result",
+    ("cache", "result"),
+)
@@ -1,7 +1,9 @@
 import os
 import json
 import logging
-import requests
+from metrics import STAGE_LATENCY, record_fallback
+from sharedCache import CACHE
+from upstream import model_reply_has, run_model
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +29,7 @@ HARDCODED_OUTFITS = {
     ]
 }
 
+@STAGE_LATENCY.timed(stage="outfits")
 def generateOutfits(profile_data: dict) -> dict:
     # Get Cloudflare credentials
     api_token = os.getenv('CLOUDFLARE_API_TOKEN')
@@ -35,7 +38,13 @@ def generateOutfits(profile_data: dict) -> dict:
     # If credentials are missing, return hardcoded outfits immediately
     if not api_token or not account_id:
         logger.info("Missing Cloudflare credentials - returning hardcoded outfits")
+        record_fallback("outfits", "missing_credentials")
         return HARDCODED_OUTFITS
+
+    # Another worker may already have generated outfits for this profile
+    cached = CACHE.get_outfits(profile_data)
+    if cached is not None:
+        return cached
     
     # Construct the system prompt
     system_prompt = """
@@ -56,30 +65,23 @@ def generateOutfits(profile_data: dict) -> dict:
     
     # Make the API request to Cloudflare Workers AI
     try:
-        url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/@cf/meta/llama-2-7b-chat-int8"
-        headers = {
-            "Authorization": f"Bearer {api_token}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "messages": [
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                    {
-                        "role": "user",
-                    "content": json.dumps(profile_data)
-                }
-            ]
-        }
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": json.dumps(profile_data)
+            }
+        ]
         
-        response = requests.post(url, headers=headers, json=data)
+        response = run_model("outfits", account_id, api_token, messages, validate=model_reply_has("outfit_recommendations"))
         
         # If API call fails, return hardcoded outfits
         if response.status_code != 200:
-            logger.info(f"API call failed with status {response.status_code} - returning hardcoded outfits")
+            logger.info("API call failed with status %s - returning hardcoded outfits", response.status_code)
+            record_fallback("outfits", "upstream_status")
             return HARDCODED_OUTFITS
             
         result = response.json()
@@ -87,21 +89,26 @@ def generateOutfits(profile_data: dict) -> dict:
         # If response parsing fails, return hardcoded outfits
         if 'result' not in result or 'response' not in result['result']:
             logger.info("Invalid API response format - returning hardcoded outfits")
+            record_fallback("outfits", "invalid_response")
             return HARDCODED_OUTFITS
             
         try:
             outfits = json.loads(result['result']['response'])
             if isinstance(outfits, dict) and 'outfit_recommendations' in outfits:
+                CACHE.set_outfits(profile_data, outfits)
                 return outfits
         except json.JSONDecodeError:
             logger.info("Failed to parse API response - returning hardcoded outfits")
+            record_fallback("outfits", "unparseable_response")
             return HARDCODED_OUTFITS
             
         # If we get here, something went wrong with the response format
         logger.info("Invalid outfit format in API response - returning hardcoded outfits")
+        record_fallback("outfits", "invalid_format")
         return HARDCODED_OUTFITS
 
     except Exception as e:
-        logger.error(f"Error in outfit generation: {str(e)}")
+        logger.error("Error in outfit generation: %s", e)
         logger.info("Returning hardcoded outfits due to error")
+        record_fallback("outfits", "upstream_error")
         return HARDCODED_OUTFITS
@@ -0,0 +1,27 @@
+from typing import Any, Dict, List
+
+from profileGenerator import generateProfile, HARDCODED_PROFILE
+from outfitGenerator import generateOutfits, HARDCODED_OUTFITS
+from itemGenerator import generateItems, FallbackItems
+
+def run_pipeline(image_files: List[str]) -> Dict[str, Any]:
+    """
+    Profile the images, recommend outfits for that profile, then items for
+    those outfits. Blocking; run it in a worker thread from async code.
+    """
+    profile = generateProfile(image_files)
+
+    # Generate outfit recommendations
+    outfits = generateOutfits(profile)
+
+    items = generateItems(outfits)
+
+    return {"profile": profile, "outfit_recommendations": outfits, "items": items}
+
+def used_fallback(result: Dict[str, Any]) -> bool:
+    """True if any stage of a run_pipeline result is a hardcoded fallback."""
+    return (
+        result.get("profile") is HARDCODED_PROFILE
+        or result.get("outfit_recommendations") is HARDCODED_OUTFITS
+        or isinstance(result.get("items"), FallbackItems)
+    )
@@ -3,10 +3,15 @@ import json
 from typing import List, Dict, Any
 import base64
 import logging
-import requests
+from logSetup import HIGH_VOLUME
+from metrics import STAGE_LATENCY, record_fallback
+from sharedCache import CACHE, images_key
+from upstream import model_reply_has, run_model
 
 logger = logging.getLogger(__name__)
 
+REQUIRED_FIELDS = ["Age", "Occupation", "Location", "Ethnicity", "Attire Style", "Style Archetype"]
+
 # Hardcoded profile data for error cases
 HARDCODED_PROFILE = {
     "Age": 25,
@@ -20,41 +25,55 @@ HARDCODED_PROFILE = {
     "Influence": "Street Fashion"
 }
 
+def encode_image_message(image_file: str) -> Dict[str, Any]:
+    """
+    Read an image and wrap it as a base64 data-URI message for the model.
+    """
+    with open(image_file, 'rb') as file:
+        image_data = file.read()
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/jpeg;base64,{base64.b64encode(image_data).decode('ascii')}"
+        }
+    }
+
+@STAGE_LATENCY.timed(stage="profile")
 def generateProfile(image_files: List[str]) -> Dict[str, Any]:
     # Get Cloudflare credentials
     api_token = os.getenv('CLOUDFLARE_API_TOKEN')
     account_id = os.getenv('CLOUDFLARE_ACCOUNT_ID')
     
-    # Log the credentials (masking the token for security)
-    logger.info(f"Account ID: {account_id}")
-    logger.info(f"API Token present: {'Yes' if api_token else 'No'}")
-    logger.info(f"API Token length: {len(api_token) if api_token else 0}")
+    # Log whether credentials are configured, never the token itself
+    logger.debug("Account ID: %s, API token present: %s", account_id, bool(api_token))
     
     if not api_token or not account_id:
         logger.error("Missing Cloudflare credentials")
         logger.info("Returning hardcoded profile due to missing credentials")
+        record_fallback("profile", "missing_credentials")
         return HARDCODED_PROFILE
     
     if not image_files:
         logger.error("No image files provided")
         logger.info("Returning hardcoded profile due to no images")
+        record_fallback("profile", "no_images")
         return HARDCODED_PROFILE
+
+    # Another worker may already have profiled these exact images
+    cache_key = images_key(image_files) if CACHE.enabled else None
+    cached = CACHE.get_profile(cache_key)
+    if cached is not None:
+        return cached
     
     # Prepare the images for the API request
     image_messages = []
     for image_file in image_files:
         try:
-            with open(image_file, 'rb') as file:
-                image_data = file.read()
-                image_messages.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64.b64encode(image_data).decode('utf-8')}"
-                    }
-                })
+            image_messages.append(encode_image_message(image_file))
         except Exception as e:
-            logger.error(f"Error reading image file {image_file}: {str(e)}")
+            logger.error("Error reading image file %s: %s", image_file, e)
             logger.info("Returning hardcoded profile due to image reading error")
+            record_fallback("profile", "image_read_error")
             return HARDCODED_PROFILE
     
     # Construct the system prompt
@@ -87,55 +106,45 @@ def generateProfile(image_files: List[str]) -> Dict[str, Any]:
     # Make the API request to Cloudflare Workers AI
     try:
         logger.info("Sending request to Cloudflare Workers AI")
-        url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/@cf/meta/llama-2-7b-chat-int8"
-        headers = {
-            "Authorization": f"Bearer {api_token}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "messages": [
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": json.dumps(image_messages)
-                }
-            ]
-        }
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": json.dumps(image_messages)
+            }
+        ]
 
-        logger.info(f"Request URL: {url}")
-        logger.info(f"Request headers: {headers}")
-        logger.info(f"Request data: {data}")
+        logger.debug("Sending %d images", len(image_messages))
 
-        response = requests.post(url, headers=headers, json=data)
-        logger.info(f"Response status code: {response.status_code}")
-        logger.info(f"Response headers: {response.headers}")
-        logger.info(f"Response content: {response.text}")
+        response = run_model("profile", account_id, api_token, messages, validate=model_reply_has(*REQUIRED_FIELDS))
+        logger.info("Response status code: %s", response.status_code, extra=HIGH_VOLUME)
+        logger.debug("Response content: %s", response.text)
         
         response.raise_for_status()
         result = response.json()
         
-        logger.info(f"Received response from Cloudflare: {result}")
-        
         # Parse the response
         profile_data = json.loads(result['result']['response'])
         
         # Validate required fields
-        required_fields = ["Age", "Occupation", "Location", "Ethnicity", "Attire Style", "Style Archetype"]
-        for field in required_fields:
+        for field in REQUIRED_FIELDS:
             if field not in profile_data:
-                logger.error(f"Missing required field in profile: {field}")
+                logger.error("Missing required field in profile: %s", field)
                 logger.info("Returning hardcoded profile due to missing fields")
+                record_fallback("profile", "missing_fields")
                 return HARDCODED_PROFILE
         
-        logger.info(f"Successfully generated profile: {profile_data}")
+        logger.debug("Successfully generated profile: %s", profile_data)
+        CACHE.set_profile(cache_key, profile_data)
         return profile_data
     
     except Exception as e:
-        logger.error(f"Error generating profile: {str(e)}")
+        logger.error("Error generating profile: %s", e)
         logger.info("Returning hardcoded profile due to error")
+        invalid = isinstance(e, (json.JSONDecodeError, KeyError, TypeError))
+        record_fallback("profile", "invalid_response" if invalid else "upstream_error")
         return HARDCODED_PROFILE
   
\ No newline at end of file
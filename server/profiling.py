@@ -0,0 +1,194 @@
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+
+logger = logging.getLogger(__name__)
+
+# Profiling is only wired up when a token is configured; otherwise there is
+# no middleware at all and requests pay nothing.
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_TOP = 25
+
+# Innermost frames in these files mean the thread is parked, not working
+_IDLE_FILES = ("threading.py", "selectors.py", "queue.py")
+
+_busy = threading.Lock()
+
+class StackSampler:
+    """
+    Samples every thread's stack at a fixed interval and counts collapsed
+    stacks ("outer;inner;leaf"), the input format flamegraph.pl and
+    speedscope read. Samples are process-wide: concurrent requests show up
+    too, so profile on a quiet replica when possible.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or frame.f_code.co_filename.endswith(_IDLE_FILES):
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+                self.samples += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def top_functions(self, limit: int = PROFILE_TOP) -> List[Dict[str, Any]]:
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return [
+            {"function": name, "samples": count, "share": round(count / max(self.samples, 1), 4)}
+            for name, count in leaves.most_common(limit)
+        ]
+
+def _top_allocations(snapshot: tracemalloc.Snapshot, limit: int = PROFILE_TOP) -> List[Dict[str, Any]]:
+    return [
+        {"site": str(stat.traceback), "size_bytes": stat.size, "count": stat.count}
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+def _authorized(supplied: Optional[str]) -> bool:
+    return bool(supplied) and hmac.compare_digest(supplied.encode(), PROFILING_TOKEN.encode())
+
+def _path(profile_id: str, suffix: str) -> str:
+    return os.path.join(PROFILE_DIR, f"{profile_id}{suffix}")
+
+async def profile_request(request: Request, call_next):
+    # Header only: a query parameter would put the token in the access log
+    supplied = request.headers.get("x-profile")
+    if supplied is None:
+        return await call_next(request)
+    if not _authorized(supplied):
+        return JSONResponse(status_code=403, content={"detail": "Invalid profiling token"})
+    if not _busy.acquire(blocking=False):
+        response = await call_next(request)
+        response.headers["X-Profile-Status"] = "busy"
+        return response
+
+    try:
+        mode = request.headers.get("x-profile-mode", "sampling")
+        profile_id = uuid.uuid4().hex[:12]
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10)
+        sampler = profiler = None
+        if mode == "cprofile":
+            # Deterministic, but only sees the event-loop thread (async
+            # handlers and response rendering), not the sync threadpool.
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler = StackSampler()
+            sampler.start()
+
+        started = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+            if sampler is not None:
+                sampler.stop()
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+
+        summary: Dict[str, Any] = {
+            "id": profile_id,
+            "method": request.method,
+            "path": request.url.path,
+            "mode": mode,
+            "duration_ms": round(elapsed * 1000, 2),
+            "top_allocations": _top_allocations(snapshot),
+        }
+        if profiler is not None:
+            profiler.dump_stats(_path(profile_id, ".pstats"))
+            stats = pstats.Stats(profiler)
+            summary["top_functions"] = [
+                {
+                    "function": f"{name} ({os.path.basename(filename)}:{line})",
+                    "calls": calls,
+                    "cumulative_ms": round(cumulative * 1000, 3),
+                }
+                for (filename, line, name), (_, calls, _, cumulative, _) in sorted(
+                    stats.stats.items(), key=lambda item: item[1][3], reverse=True
+                )[:PROFILE_TOP]
+            ]
+        else:
+            with open(_path(profile_id, ".folded"), "w") as f:
+                f.write(sampler.folded())
+            summary["samples"] = sampler.samples
+            summary["top_functions"] = sampler.top_functions()
+        with open(_path(profile_id, ".json"), "w") as f:
+            json.dump(summary, f, indent=2)
+
+        logger.info("Profiled %s %s as %s (%.1f ms)", request.method, request.url.path, profile_id, elapsed * 1000)
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+    finally:
+        _busy.release()
+
+def get_profile(profile_id: str, request: Request):
+    if not _authorized(request.headers.get("x-profile")):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+    if not profile_id.isalnum():
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    fmt = request.query_params.get("format", "json")
+    suffix = {"json": ".json", "folded": ".folded", "pstats": ".pstats"}.get(fmt)
+    if suffix is None or not os.path.exists(_path(profile_id, suffix)):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if fmt == "pstats":
+        with open(_path(profile_id, suffix), "rb") as f:
+            return Response(f.read(), media_type="application/octet-stream")
+    with open(_path(profile_id, suffix)) as f:
+        body = f.read()
+    if fmt == "folded":
+        return PlainTextResponse(body)
+    return Response(body, media_type="application/json")
+
+def install(app: FastAPI) -> None:
+    """Add the profiling middleware and admin route, if PROFILING_TOKEN is set."""
+    if not PROFILING_TOKEN:
+        return
+    app.middleware("http")(profile_request)
+    app.add_api_route("/admin/profiles/{profile_id}", get_profile, methods=["GET"])
@@ -0,0 +1,327 @@
+"""
+WebSocket refinement sessions.
+
+A client opens /ws/refine and sends its token (or "guest") with its profile
+in the first init/resume message, then small deltas; the server keeps the
+profile and the last outfits/items and answers each delta with only what was
+added, changed or removed.
+
+Client -> server:
+    {"type": "init", "token": "...", "profile": {...}}
+    {"type": "resume", "token": "...", "session_id": "..."}
+    {"type": "delta", "set": {"Color Palette": "Navy, Grey"},
+                      "add": {"Hobbies": ["Hiking"]},
+                      "remove": {"Hobbies": ["Gaming"]},
+                      "note": "more formal"}
+    {"type": "ping"}
+
+Server -> client:
+    {"type": "session", "session_id": "...", "version": 1, "profile": {...},
+     "outfits": {"added": [...], "changed": [...], "removed": [...]},
+     "items": {"added": [...], "changed": [...], "removed": [...]}}
+    {"type": "update", "session_id": "...", "version": 2, "outfits": {...}, "items": {...}}
+    {"type": "error", "code": "...", "message": "..."}
+    {"type": "pong"}
+"""
+import os
+import copy
+import json
+import hashlib
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+
+import imageProxy
+import scheduler
+from auth import USERS_DB, verify_session_token
+from itemGenerator import generateItems
+from metrics import Counter, Gauge
+from outfitGenerator import generateOutfits
+from rateLimit import RateLimiter
+from responseEncoding import dumps
+
+logger = logging.getLogger(__name__)
+
+REFINE_MAX_SESSIONS = int(os.getenv("REFINE_MAX_SESSIONS", "1000"))
+REFINE_IDLE_TIMEOUT = float(os.getenv("REFINE_IDLE_TIMEOUT", "900"))
+REFINE_MAX_MESSAGE_BYTES = int(os.getenv("REFINE_MAX_MESSAGE_BYTES", str(16 * 1024)))
+REFINE_MAX_PROFILE_BYTES = int(os.getenv("REFINE_MAX_PROFILE_BYTES", str(16 * 1024)))
+# Free-text notes ("more formal") kept in the profile, oldest dropped first
+REFINE_MAX_NOTES = int(os.getenv("REFINE_MAX_NOTES", "10"))
+
+MESSAGES = Counter("outfitsync_refine_messages_total", "Refinement WebSocket messages", ("type",))
+SESSIONS = Gauge("outfitsync_refine_sessions", "Live refinement sessions")
+
+router = APIRouter()
+
+class RefineError(Exception):
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+@dataclass
+class RefineSession:
+    id: str
+    owner: str
+    profile: Dict[str, Any]
+    version: int = 0
+    # id -> entry, as last sent to the client
+    outfits: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    items: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    last_used: float = field(default_factory=time.monotonic)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+class SessionStore:
+    """
+    Sessions in least-recently-used order, capped at `max_sessions` and
+    dropped once idle for `idle_timeout` seconds. Eviction runs on every
+    access, so it's O(evicted) and needs no background task. Sessions outlive
+    their connection until evicted, so a client can resume after a reconnect.
+    """
+
+    def __init__(self, max_sessions: int = REFINE_MAX_SESSIONS, idle_timeout: float = REFINE_IDLE_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions: "OrderedDict[str, RefineSession]" = OrderedDict()
+        SESSIONS.set_function(lambda: len(self._sessions))
+
+    def _evict(self) -> None:
+        deadline = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if oldest.last_used >= deadline and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.popitem(last=False)
+
+    def create(self, owner: str, profile: Dict[str, Any]) -> RefineSession:
+        session = RefineSession(id=uuid.uuid4().hex, owner=owner, profile=profile)
+        self._sessions[session.id] = session
+        self._evict()
+        return session
+
+    def get(self, session_id: str, owner: str) -> Optional[RefineSession]:
+        self._evict()
+        session = self._sessions.get(session_id)
+        if session is None or session.owner != owner:
+            return None
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+SESSION_STORE = SessionStore()
+# Each message that regenerates results costs a token, like an HTTP request
+LIMITER = RateLimiter()
+
+def _check_profile(profile: Any) -> Dict[str, Any]:
+    if not isinstance(profile, dict):
+        raise RefineError("invalid_profile", "profile must be an object")
+    if len(dumps(profile)) > REFINE_MAX_PROFILE_BYTES:
+        raise RefineError("profile_too_large", f"profile exceeds {REFINE_MAX_PROFILE_BYTES} bytes")
+    return profile
+
+def _as_list(value: Any) -> List[Any]:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, str):
+        return [part.strip() for part in value.split(",") if part.strip()]
+    return [value]
+
+def apply_delta(profile: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a new profile with `delta` applied. `set` replaces fields (None
+    deletes), `add`/`remove` edit list fields (comma-separated strings like
+    "Color Palette" keep their string form), and `note` appends free text.
+    """
+    for op in ("set", "add", "remove"):
+        if delta.get(op) is not None and not isinstance(delta[op], dict):
+            raise RefineError("invalid_delta", f"{op} must be an object")
+    updated = copy.deepcopy(profile)
+    for key, value in (delta.get("set") or {}).items():
+        if value is None:
+            updated.pop(key, None)
+        else:
+            updated[key] = value
+    for op in ("add", "remove"):
+        for key, values in (delta.get(op) or {}).items():
+            current = updated.get(key)
+            entries = _as_list(current)
+            for value in _as_list(values):
+                if op == "add" and value not in entries:
+                    entries.append(value)
+                elif op == "remove" and value in entries:
+                    entries.remove(value)
+            updated[key] = ", ".join(map(str, entries)) if isinstance(current, str) else entries
+    note = delta.get("note")
+    if isinstance(note, str) and note.strip():
+        updated["Refinements"] = (_as_list(updated.get("Refinements")) + [note.strip()])[-REFINE_MAX_NOTES:]
+    return updated
+
+def _entry_id(entry: Dict[str, Any]) -> str:
+    """
+    Stable id for an outfit/item: its image URL and description (outfits may
+    share an image). Other fields, like price, changing make it "changed".
+    """
+    key = f"{entry.get('url') or ''}\0{entry.get('description') or ''}"
+    if key == "\0":
+        key = dumps(entry).decode("utf-8")
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+def _flatten_items(items: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Items come back either as {"items": [...]} or per category {"casual": {"items": [...]}}."""
+    if isinstance(items.get("items"), list):
+        return [item for item in items["items"] if isinstance(item, dict)]
+    flat = []
+    for category, data in items.items():
+        if isinstance(data, dict) and isinstance(data.get("items"), list):
+            flat.extend(dict(item, category=category) for item in data["items"] if isinstance(item, dict))
+    return flat
+
+def diff(previous: Dict[str, Dict[str, Any]], entries: List[Dict[str, Any]]) -> Tuple[Dict[str, List], Dict[str, Dict[str, Any]]]:
+    """
+    Compare `entries` with the set last sent. Returns the changes (entries
+    carry an `id`; `removed` lists ids) and the new set.
+    """
+    current: Dict[str, Dict[str, Any]] = {}
+    for entry in entries:
+        entry_id = _entry_id(entry)
+        current.setdefault(entry_id, dict(entry, id=entry_id))
+    changes = {
+        "added": [entry for entry_id, entry in current.items() if entry_id not in previous],
+        "changed": [entry for entry_id, entry in current.items() if entry_id in previous and previous[entry_id] != entry],
+        "removed": [entry_id for entry_id in previous if entry_id not in current],
+    }
+    return changes, current
+
+def _generate(profile: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    outfits = generateOutfits(profile)
+    items = generateItems(outfits)
+    recommendations = outfits.get("outfit_recommendations", []) if isinstance(outfits, dict) else []
+    return [o for o in recommendations if isinstance(o, dict)], _flatten_items(items if isinstance(items, dict) else {})
+
+async def _refresh(session: RefineSession, profile: Dict[str, Any], base_url: str) -> Dict[str, Any]:
+    outfits, items = await asyncio.to_thread(_generate, profile)
+    outfit_changes, session.outfits = diff(session.outfits, outfits)
+    item_changes, session.items = diff(session.items, items)
+    session.profile = profile
+    session.version += 1
+    return {
+        "session_id": session.id,
+        "version": session.version,
+        "outfits": imageProxy.rewrite_urls(outfit_changes, base_url),
+        "items": imageProxy.rewrite_urls(item_changes, base_url),
+    }
+
+def _parse(text: str) -> Dict[str, Any]:
+    try:
+        message = json.loads(text)
+    except json.JSONDecodeError:
+        raise RefineError("invalid_json", "messages must be JSON objects")
+    if not isinstance(message, dict):
+        raise RefineError("invalid_json", "messages must be JSON objects")
+    return message
+
+async def _authenticate(websocket: WebSocket, token: Any) -> Optional[str]:
+    """
+    Owner of the connection: the user's email, or the client IP for guests.
+    The token comes in the first message, not the URL, so it never reaches
+    access logs.
+    """
+    if not isinstance(token, str):
+        return None
+    host = websocket.client.host if websocket.client else "anonymous"
+    if token == "guest":
+        scheduler.set_priority(scheduler.GUEST, host)
+        return "guest:" + host
+    token_data = await verify_session_token(USERS_DB, token) if token else None
+    if token_data is None:
+        return None
+    # A refinement is someone waiting on screen for the answer
+    scheduler.set_priority(scheduler.INTERACTIVE, token_data.email)
+    return token_data.email
+
+async def _handle(message: Dict[str, Any], owner: str, current: Optional[RefineSession],
+                  base_url: str) -> Tuple[Dict[str, Any], Optional[RefineSession]]:
+    kind = message.get("type")
+    MESSAGES.inc(type=kind if kind in ("init", "resume", "delta", "ping") else "other")
+    if kind == "ping":
+        return {"type": "pong"}, current
+
+    if kind == "resume":
+        session = SESSION_STORE.get(str(message.get("session_id", "")), owner)
+        if session is None:
+            raise RefineError("unknown_session", "session expired or not found; send init")
+        return {"type": "session", "session_id": session.id, "version": session.version, "profile": session.profile,
+                "outfits": imageProxy.rewrite_urls({"added": list(session.outfits.values()), "changed": [], "removed": []}, base_url),
+                "items": imageProxy.rewrite_urls({"added": list(session.items.values()), "changed": [], "removed": []}, base_url)}, session
+
+    if kind not in ("init", "delta"):
+        raise RefineError("unknown_type", f"unknown message type {kind!r}")
+
+    allowed, retry_after = LIMITER.take(owner)
+    if not allowed:
+        raise RefineError("rate_limited", f"retry in {retry_after:.1f}s")
+
+    if kind == "init":
+        profile = _check_profile(message.get("profile"))
+        session = SESSION_STORE.create(owner, profile)
+        async with session.lock:
+            update = await _refresh(session, profile, base_url)
+        return dict(update, type="session", profile=profile), session
+
+    if current is None:
+        raise RefineError("no_session", "send init or resume first")
+    async with current.lock:
+        profile = _check_profile(apply_delta(current.profile, message))
+        if profile == current.profile:
+            empty = {"added": [], "changed": [], "removed": []}
+            return {"type": "update", "session_id": current.id, "version": current.version,
+                    "outfits": empty, "items": empty}, current
+        update = await _refresh(current, profile, base_url)
+    return dict(update, type="update"), current
+
+@router.websocket("/ws/refine")
+async def refine(websocket: WebSocket):
+    await websocket.accept()
+    base_url = imageProxy.base_url_for(websocket)
+    owner: Optional[str] = None
+    session: Optional[RefineSession] = None
+    try:
+        while True:
+            text = await websocket.receive_text()
+            if len(text) > REFINE_MAX_MESSAGE_BYTES:
+                await websocket.send_text(dumps({"type": "error", "code": "message_too_large",
+                                                 "message": f"messages are limited to {REFINE_MAX_MESSAGE_BYTES} bytes"}).decode("utf-8"))
+                continue
+            try:
+                message = _parse(text)
+                if owner is None:
+                    if message.get("type") not in ("init", "resume"):
+                        raise RefineError("unauthorized", "the first message must be init or resume with a token")
+                    owner = await _authenticate(websocket, message.get("token"))
+                    if owner is None:
+                        await websocket.send_text(dumps({"type": "error", "code": "unauthorized",
+                                                         "message": "invalid token"}).decode("utf-8"))
+                        await websocket.close(code=1008)
+                        return
+                reply, session = await _handle(message, owner, session, base_url)
+            except RefineError as e:
+                reply = {"type": "error", "code": e.code, "message": e.message}
+            except Exception as e:
+                # One bad message mustn't drop the session's connection
+                logger.exception("Refine message failed: %s", e)
+                reply = {"type": "error", "code": "internal_error", "message": "could not process message"}
+            await websocket.send_text(dumps(reply).decode("utf-8"))
+    except WebSocketDisconnect:
+        pass
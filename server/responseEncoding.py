@@ -0,0 +1,119 @@
+import os
+import json
+import gzip
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from metrics import record_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this aren't worth the compression CPU or the header bytes
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+STATIC_CACHE_SIZE = int(os.getenv("STATIC_CACHE_SIZE", "256"))
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+_MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+VARY = "Accept, Accept-Encoding"
+
+# (key, media type, accepted encoding) -> (body, content-encoding)
+_static: Dict[Tuple[Hashable, str, Optional[str]], Tuple[bytes, Optional[str]]] = {}
+_static_lock = threading.Lock()
+
+def dumps(payload: Any) -> bytes:
+    """Compact JSON; orjson when installed, the stdlib otherwise."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload)
+        except TypeError:
+            # e.g. non-str dict keys; let the stdlib (and default=str) deal with it
+            pass
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+def media_type_for(request: Request) -> str:
+    accept = request.headers.get("accept", "")
+    if msgpack is not None and any(t in accept for t in _MSGPACK_TYPES):
+        return MSGPACK
+    return JSON
+
+def encoding_for(request: Request) -> Optional[str]:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").lower().replace(" ", "").split(","):
+        coding, _, params = part.partition(";")
+        if params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def encode(payload: Any, media_type: str) -> bytes:
+    if media_type == MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True, default=str)
+    return dumps(payload)
+
+def compress(body: bytes, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """Compress `body` if it's large enough. Returns (body, content-encoding)."""
+    if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), "gzip"
+
+def _response(body: bytes, media_type: str, content_encoding: Optional[str],
+              status_code: int, headers: Optional[Dict[str, str]]) -> Response:
+    headers = dict(headers or {})
+    headers["Vary"] = VARY
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+    return Response(body, status_code=status_code, headers=headers, media_type=media_type)
+
+def respond(request: Request, payload: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Encode `payload` as the client asked: MessagePack when Accept names it
+    (and msgpack is installed), JSON otherwise, then brotli or gzip per
+    Accept-Encoding once the body passes COMPRESS_MIN_BYTES.
+    """
+    media_type = media_type_for(request)
+    body, content_encoding = compress(encode(payload, media_type), encoding_for(request))
+    return _response(body, media_type, content_encoding, status_code, headers)
+
+def respond_static(request: Request, key: Hashable, build: Callable[[], Any],
+                   status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Like respond(), for payloads that never change for a given `key` (the
+    hardcoded fallbacks): each media type/encoding combination is built,
+    encoded and compressed once, then served from memory.
+    """
+    media_type = media_type_for(request)
+    encoding = encoding_for(request)
+    cache_key = (key, media_type, encoding)
+    encoded = _static.get(cache_key)
+    record_cache("static_body", encoded is not None)
+    if encoded is None:
+        encoded = compress(encode(build(), media_type), encoding)
+        with _static_lock:
+            if len(_static) >= STATIC_CACHE_SIZE:
+                _static.pop(next(iter(_static)))
+            _static[cache_key] = encoded
+    return _response(encoded[0], media_type, encoded[1], status_code, headers)
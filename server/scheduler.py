@@ -0,0 +1,147 @@
+import os
+import heapq
+import time
+import itertools
+import threading
+import contextvars
+from typing import Dict, List, Optional
+
+from metrics import Gauge, Histogram
+
+UPSTREAM_SLOTS = int(os.getenv("UPSTREAM_SLOTS", "8"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "30"))
+
+# Lower value wins. Interactive is assigned by the server only (live
+# refinement sockets), guests never outrank signed-in users, and batch work
+# (jobs, bulk runs, X-Priority: background) only gets slots nobody
+# interactive is waiting for.
+INTERACTIVE = 0
+AUTHENTICATED = 1
+GUEST = 2
+BATCH = 3
+PRIORITY_NAMES = ("interactive", "authenticated", "guest", "batch")
+
+# Flow bookkeeping is trimmed once a class tracks this many flows
+_MAX_FLOWS = 10000
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("upstream_priority", default=GUEST)
+_flow: contextvars.ContextVar[str] = contextvars.ContextVar("upstream_flow", default="anonymous")
+_weight: contextvars.ContextVar[float] = contextvars.ContextVar("upstream_weight", default=1.0)
+
+QUEUE_WAIT = Histogram(
+    "outfitsync_upstream_queue_wait_seconds",
+    "Time generator calls waited for an upstream slot",
+    ("priority",),
+)
+QUEUED = Gauge("outfitsync_upstream_queued", "Generator calls waiting for an upstream slot", ("priority",))
+SLOTS_BUSY = Gauge("outfitsync_upstream_slots_busy", "Upstream slots in use")
+
+class SchedulerTimeout(Exception):
+    """Raised when a call waits longer than its timeout for an upstream slot."""
+
+def set_priority(priority: int, flow: str, weight: float = 1.0) -> None:
+    """
+    Tag the current context (request, job or task) with its scheduling class
+    and flow. Worker threads started from this context inherit the tags.
+    """
+    _priority.set(priority)
+    _flow.set(flow)
+    _weight.set(weight)
+
+class _Ticket:
+    __slots__ = ("priority", "finish", "seq", "event", "granted", "cancelled")
+
+    def __init__(self, priority: int, finish: float, seq: int):
+        self.priority = priority
+        self.finish = finish
+        self.seq = seq
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+    def __lt__(self, other: "_Ticket") -> bool:
+        return (self.finish, self.seq) < (other.finish, other.seq)
+
+class UpstreamScheduler:
+    """
+    Owns a fixed number of concurrent upstream slots and hands free slots to
+    waiting callers by strict priority class, then by weighted fair queuing
+    within the class: each call gets a virtual finish tag of
+    max(class virtual time, flow's last tag) + 1 / weight, and the smallest
+    tag goes first, so one busy flow can't starve others in its class.
+
+    Callers block in a thread (the generators are synchronous), so this is
+    built on threading primitives rather than asyncio.
+    """
+
+    def __init__(self, slots: int = UPSTREAM_SLOTS):
+        self.slots = slots
+        self._free = slots
+        self._lock = threading.Lock()
+        self._queues: List[List[_Ticket]] = [[] for _ in PRIORITY_NAMES]
+        self._virtual = [0.0 for _ in PRIORITY_NAMES]
+        self._flow_finish: List[Dict[str, float]] = [{} for _ in PRIORITY_NAMES]
+        self._seq = itertools.count()
+        for priority, name in enumerate(PRIORITY_NAMES):
+            QUEUED.set_function(lambda p=priority: len(self._queues[p]), priority=name)
+        SLOTS_BUSY.set_function(lambda: self.slots - self._free)
+
+    def _enqueue(self, priority: int, flow: str, weight: float) -> _Ticket:
+        flows = self._flow_finish[priority]
+        start = max(self._virtual[priority], flows.get(flow, 0.0))
+        finish = start + 1.0 / max(weight, 1e-6)
+        flows[flow] = finish
+        if len(flows) > _MAX_FLOWS:
+            virtual = self._virtual[priority]
+            for stale in [f for f, tag in flows.items() if tag <= virtual]:
+                del flows[stale]
+        ticket = _Ticket(priority, finish, next(self._seq))
+        heapq.heappush(self._queues[priority], ticket)
+        return ticket
+
+    def try_acquire(self) -> bool:
+        """Take a slot only if one is free and nobody is waiting."""
+        with self._lock:
+            if self._free > 0 and not any(self._queues):
+                self._free -= 1
+                return True
+            return False
+
+    def acquire(self, priority: Optional[int] = None, flow: Optional[str] = None,
+                weight: Optional[float] = None, timeout: Optional[float] = UPSTREAM_QUEUE_TIMEOUT) -> None:
+        priority = _priority.get() if priority is None else priority
+        flow = _flow.get() if flow is None else flow
+        weight = _weight.get() if weight is None else weight
+        label = PRIORITY_NAMES[priority]
+        started = time.perf_counter()
+
+        with self._lock:
+            if self._free > 0 and not any(self._queues):
+                self._free -= 1
+                QUEUE_WAIT.observe(0.0, priority=label)
+                return
+            ticket = self._enqueue(priority, flow, weight)
+
+        if not ticket.event.wait(timeout):
+            with self._lock:
+                if not ticket.granted:
+                    # Left in the heap; release() skips cancelled tickets
+                    ticket.cancelled = True
+                    QUEUE_WAIT.observe(time.perf_counter() - started, priority=label)
+                    raise SchedulerTimeout(f"No upstream slot within {timeout}s")
+        QUEUE_WAIT.observe(time.perf_counter() - started, priority=label)
+
+    def release(self) -> None:
+        with self._lock:
+            for priority, queue in enumerate(self._queues):
+                while queue:
+                    ticket = heapq.heappop(queue)
+                    if ticket.cancelled:
+                        continue
+                    self._virtual[priority] = ticket.finish
+                    ticket.granted = True
+                    ticket.event.set()
+                    return
+            self._free += 1
+
+SCHEDULER = UpstreamScheduler()
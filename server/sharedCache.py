@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import sqlite3
+from typing import Any, Callable, Dict, List, Optional
+
+from db import SQLitePool
+from metrics import Counter, record_cache
+
+logger = logging.getLogger(__name__)
+
+SHARED_CACHE = os.getenv("SHARED_CACHE", "1").lower() in ("1", "true", "yes")
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "data/shared_cache.db")
+SHARED_CACHE_MAX_BYTES = int(os.getenv("SHARED_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+SHARED_CACHE_TTL = float(os.getenv("SHARED_CACHE_TTL", str(24 * 3600)))
+SHARED_CACHE_POOL_SIZE = int(os.getenv("SHARED_CACHE_POOL_SIZE", "8"))
+# How long a worker may hold the right to compute an entry before others give up waiting
+SHARED_CACHE_LEASE_TTL = float(os.getenv("SHARED_CACHE_LEASE_TTL", "120"))
+# Reads refresh an entry's LRU timestamp at most this often, so hits rarely write
+ACCESS_GRANULARITY = 60.0
+EVICT_INTERVAL = 30.0
+
+EVICTIONS = Counter("outfitsync_shared_cache_evictions_total", "Shared cache entries removed", ("reason",))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires_at);
+"""
+
+_LEASES = "lease"
+
+def _init_db(conn) -> None:
+    conn.executescript(_SCHEMA)
+
+def json_key(value: Any) -> str:
+    """Cache key for a JSON-able value: digest of its canonical encoding."""
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def images_key(image_files: List[str]) -> Optional[str]:
+    """Cache key for a set of images, by content; None if one can't be read."""
+    digest = hashlib.sha256()
+    try:
+        for path in sorted(image_files):
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+class SharedCache:
+    """
+    A result cache shared by every worker process on the host: one SQLite
+    database in WAL mode, so readers never block each other or the writer.
+    Entries expire after a TTL and the least recently used are evicted once
+    the values pass `max_bytes`. add_if_absent() is atomic across processes
+    and backs get_or_compute(), so concurrent misses for the same key are
+    computed by one worker while the others wait for its result.
+    """
+
+    def __init__(self, path: str = SHARED_CACHE_PATH, max_bytes: int = SHARED_CACHE_MAX_BYTES,
+                 default_ttl: float = SHARED_CACHE_TTL, pool_size: int = SHARED_CACHE_POOL_SIZE,
+                 enabled: bool = True):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.pool = SQLitePool(path, size=pool_size, init=_init_db)
+        self._last_evict = 0.0
+
+    def get(self, ns: str, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self.pool.connection() as conn:
+                row = conn.execute(
+                    "SELECT value, accessed_at FROM entries WHERE ns = ? AND key = ? AND expires_at > ?",
+                    (ns, key, now),
+                ).fetchone()
+                if row is not None and row["accessed_at"] < now - ACCESS_GRANULARITY:
+                    conn.execute("UPDATE entries SET accessed_at = ? WHERE ns = ? AND key = ?", (now, ns, key))
+        except sqlite3.Error as e:
+            # A broken cache is a miss, never a failed request
+            logger.warning("Shared cache read failed: %s", e)
+            row = None
+        if ns != _LEASES:
+            record_cache(f"shared_{ns}", row is not None)
+        return json.loads(row["value"]) if row is not None else None
+
+    def set(self, ns: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        if not self.enabled:
+            return
+        encoded = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        now = time.time()
+        try:
+            with self.pool.connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (ns, key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (ns, key, encoded, len(encoded), now + (ttl or self.default_ttl), now),
+                )
+        except sqlite3.Error as e:
+            logger.warning("Shared cache write failed: %s", e)
+            return
+        self._maybe_evict()
+
+    def add_if_absent(self, ns: str, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """
+        Store `value` unless a live entry exists. True if this call stored it;
+        also True when the cache is off or unavailable, so callers that use it
+        as a lock go ahead rather than wait on nothing.
+        """
+        if not self.enabled:
+            return True
+        encoded = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        now = time.time()
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.execute(
+                    """
+                    INSERT INTO entries (ns, key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (ns, key) DO UPDATE SET
+                        value = excluded.value, size = excluded.size,
+                        expires_at = excluded.expires_at, accessed_at = excluded.accessed_at
+                    WHERE entries.expires_at <= ?
+                    """,
+                    (ns, key, encoded, len(encoded), now + (ttl or self.default_ttl), now, now),
+                )
+                return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            logger.warning("Shared cache add failed: %s", e)
+            return True
+
+    def delete(self, ns: str, key: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            with self.pool.connection() as conn:
+                conn.execute("DELETE FROM entries WHERE ns = ? AND key = ?", (ns, key))
+        except sqlite3.Error as e:
+            logger.warning("Shared cache delete failed: %s", e)
+
+    def get_or_compute(self, ns: str, key: str, compute: Callable[[], Any], ttl: Optional[float] = None,
+                       cacheable: Callable[[Any], bool] = lambda value: True) -> Any:
+        """
+        Return the cached value, or compute it. Only the worker that wins the
+        lease computes; the rest poll for its result and compute themselves
+        only if the lease holder finishes without caching anything (e.g. it
+        got a fallback) or the lease expires.
+        """
+        if not self.enabled:
+            return compute()
+        value = self.get(ns, key)
+        if value is not None:
+            return value
+        lease_key = f"{ns}:{key}"
+        if self.add_if_absent(_LEASES, lease_key, f"{os.getpid()}:{uuid.uuid4().hex}", SHARED_CACHE_LEASE_TTL):
+            try:
+                value = compute()
+                if cacheable(value):
+                    self.set(ns, key, value, ttl)
+                return value
+            finally:
+                self.delete(_LEASES, lease_key)
+
+        deadline = time.monotonic() + SHARED_CACHE_LEASE_TTL
+        poll = 0.05
+        while time.monotonic() < deadline:
+            time.sleep(poll)
+            poll = min(poll * 2, 1.0)
+            value = self.get(ns, key)
+            if value is not None:
+                return value
+            if self.get(_LEASES, lease_key) is None:
+                break
+        return compute()
+
+    def _maybe_evict(self) -> None:
+        now = time.monotonic()
+        if now - self._last_evict < EVICT_INTERVAL:
+            return
+        self._last_evict = now
+        try:
+            self.evict()
+        except sqlite3.Error as e:
+            # Usually another worker holding the write lock; the next interval catches up
+            logger.debug("Shared cache eviction skipped: %s", e)
+
+    def evict(self) -> None:
+        """Drop expired entries, then least recently used ones until under `max_bytes`."""
+        with self.pool.connection() as conn:
+            expired = conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),)).rowcount
+            if expired:
+                EVICTIONS.inc(expired, reason="expired")
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            excess = total - self.max_bytes
+            if excess <= 0:
+                return
+            victims = []
+            for row in conn.execute("SELECT rowid, size FROM entries WHERE ns != ? ORDER BY accessed_at", (_LEASES,)):
+                victims.append((row["rowid"],))
+                excess -= row["size"]
+                if excess <= 0:
+                    break
+            conn.executemany("DELETE FROM entries WHERE rowid = ?", victims)
+            EVICTIONS.inc(len(victims), reason="size")
+
+    # Typed accessors for the generator results. Profiles are keyed by
+    # images_key() of their input, computed once by the caller; outfits and
+    # items by the profile or outfits they were generated from.
+
+    def get_profile(self, images: Optional[str]) -> Optional[Dict[str, Any]]:
+        return self.get("profile", images) if images is not None else None
+
+    def set_profile(self, images: Optional[str], profile: Dict[str, Any]) -> None:
+        if images is not None:
+            self.set("profile", images, profile)
+
+    def get_outfits(self, profile: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self.get("outfits", json_key(profile)) if self.enabled else None
+
+    def set_outfits(self, profile: Dict[str, Any], outfits: Dict[str, Any]) -> None:
+        self.set("outfits", json_key(profile), outfits)
+
+    def get_items(self, outfits: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self.get("items", json_key(outfits)) if self.enabled else None
+
+    def set_items(self, outfits: Dict[str, Any], items: Dict[str, Any]) -> None:
+        self.set("items", json_key(outfits), items)
+
+CACHE = SharedCache(enabled=SHARED_CACHE)
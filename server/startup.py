@@ -0,0 +1,85 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Imported first by main.py, so this is as close to "process start" as we get
+# without reading /proc.
+_T0 = time.perf_counter()
+
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "500"))
+
+_marks: List[Tuple[str, float]] = []
+_warmups: List[Tuple[str, Callable[[], Any]]] = []
+_warmup_ms: Dict[str, float] = {}
+_warmup_errors: Dict[str, str] = {}
+_ready: Dict[str, threading.Event] = {}
+_env_loaded = False
+
+def load_env_once() -> None:
+    """Load .env a single time for the whole process."""
+    global _env_loaded
+    if _env_loaded:
+        return
+    from dotenv import load_dotenv
+    load_dotenv()
+    _env_loaded = True
+
+def mark(name: str) -> None:
+    """Record how long after process start `name` was reached."""
+    _marks.append((name, (time.perf_counter() - _T0) * 1000))
+
+def warmup(name: str):
+    """
+    Register a function to run in the background once the server is accepting
+    connections. Warm-up work must be safe to run more than once.
+    """
+    def decorator(fn: Callable[[], Any]) -> Callable[[], Any]:
+        _warmups.append((name, fn))
+        _ready[name] = threading.Event()
+        return fn
+    return decorator
+
+def _run_one(name: str, fn: Callable[[], Any]) -> None:
+    started = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        _warmup_errors[name] = str(e)
+        logger.error("Warm-up %s failed: %s", name, e)
+    finally:
+        _warmup_ms[name] = (time.perf_counter() - started) * 1000
+        _ready[name].set()
+
+async def run_warmups() -> None:
+    """Run every registered warm-up in worker threads, one after another."""
+    for name, fn in _warmups:
+        await asyncio.to_thread(_run_one, name, fn)
+    mark("warm")
+    logger.info("Startup report: %s", report())
+
+async def ready(name: str, timeout: Optional[float] = 10.0) -> bool:
+    """
+    Wait until the warm-up called `name` has finished. Returns immediately if
+    it already has, or if no such warm-up was registered.
+    """
+    event = _ready.get(name)
+    if event is None or event.is_set():
+        return True
+    return await asyncio.to_thread(event.wait, timeout)
+
+def report() -> Dict[str, Any]:
+    marks = dict(_marks)
+    serving_ms = marks.get("serving")
+    return {
+        "budget_ms": STARTUP_BUDGET_MS,
+        "marks_ms": {name: round(ms, 1) for name, ms in _marks},
+        "warmup_ms": {name: round(ms, 1) for name, ms in _warmup_ms.items()},
+        "warmup_errors": dict(_warmup_errors),
+        "pending_warmups": [name for name, event in _ready.items() if not event.is_set()],
+        "within_budget": serving_ms is not None and serving_ms <= STARTUP_BUDGET_MS,
+    }
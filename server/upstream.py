@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from metrics import Counter, UPSTREAM_BYTES, UPSTREAM_LATENCY, UPSTREAM_REQUESTS
+from scheduler import SCHEDULER
+from startup import warmup
+
+# Overridable so tests and benchmarks can point at a local stand-in
+CLOUDFLARE_API_BASE = os.getenv("CLOUDFLARE_API_BASE", "https://api.cloudflare.com/client/v4").rstrip("/")
+MODEL = "@cf/meta/llama-2-7b-chat-int8"
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "60"))
+
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.2"))
+UPSTREAM_BACKOFF_CAP = float(os.getenv("UPSTREAM_BACKOFF_CAP", "5"))
+# Send a duplicate once a call is slower than this percentile of recent calls
+UPSTREAM_HEDGE = os.getenv("UPSTREAM_HEDGE", "1").lower() in ("1", "true", "yes")
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95"))
+UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.1"))
+UPSTREAM_HEDGE_MIN_SAMPLES = int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", "20"))
+# Retries and hedges together may add at most this fraction of extra calls,
+# plus a small floor so an idle server can still retry.
+UPSTREAM_RETRY_RATIO = float(os.getenv("UPSTREAM_RETRY_RATIO", "0.1"))
+UPSTREAM_RETRY_MIN_RPS = float(os.getenv("UPSTREAM_RETRY_MIN_RPS", "0.2"))
+UPSTREAM_RETRY_BURST = float(os.getenv("UPSTREAM_RETRY_BURST", "10"))
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+UPSTREAM_RETRIES = Counter("outfitsync_upstream_retries_total", "Workers AI calls retried, by stage and reason", ("stage", "reason"))
+UPSTREAM_HEDGES = Counter("outfitsync_upstream_hedges_total", "Hedged Workers AI calls, by stage and outcome", ("stage", "outcome"))
+
+Validator = Callable[[Any], bool]
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Return the process-wide requests.Session, so calls to Workers AI (and
+    SerpAPI item lookups) reuse pooled keep-alive connections instead of a
+    new TLS handshake each time.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+@warmup("http-client")
+def _preload_session() -> None:
+    get_session()
+
+def model_url(account_id: str) -> str:
+    return f"{CLOUDFLARE_API_BASE}/accounts/{account_id}/ai/run/{MODEL}"
+
+class LatencyWindow:
+    """The last `size` successful call latencies for one stage."""
+
+    def __init__(self, size: int = 256):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < UPSTREAM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class RetryBudget:
+    """
+    Token bucket shared by every stage: each first attempt deposits `ratio`
+    tokens, each retry or hedge spends one, and `min_rate` tokens per second
+    trickle in regardless. When the upstream is failing, retries stop at
+    about `ratio` of traffic instead of multiplying it.
+    """
+
+    def __init__(self, ratio: float = UPSTREAM_RETRY_RATIO, min_rate: float = UPSTREAM_RETRY_MIN_RPS,
+                 burst: float = UPSTREAM_RETRY_BURST):
+        self.ratio = ratio
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, extra: float = 0.0) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.min_rate + extra)
+        self.updated = now
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._refill(self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+RETRY_BUDGET = RetryBudget()
+_windows: Dict[str, LatencyWindow] = {}
+# Every task holds an upstream slot, so there are never more than `slots` of them
+_posts = ThreadPoolExecutor(max_workers=SCHEDULER.slots, thread_name_prefix="upstream")
+
+def model_reply_has(*keys: str) -> Validator:
+    """
+    Validator for a Workers AI chat response: HTTP 200, not marked
+    unsuccessful, and `result.response` is a JSON object with `keys`.
+    """
+    def validate(response) -> bool:
+        if response.status_code != 200:
+            return False
+        try:
+            result = response.json()
+            if result.get("success") is False:
+                return False
+            reply = json.loads(result["result"]["response"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return isinstance(reply, dict) and all(key in reply for key in keys)
+    return validate
+
+def _status_ok(response) -> bool:
+    return response.status_code == 200
+
+def _window(stage: str) -> LatencyWindow:
+    window = _windows.get(stage)
+    if window is None:
+        window = _windows.setdefault(stage, LatencyWindow())
+    return window
+
+def hedge_delay(stage: str) -> Optional[float]:
+    """How long to wait before hedging a `stage` call, or None to not hedge."""
+    if not UPSTREAM_HEDGE:
+        return None
+    delay = _window(stage).percentile(UPSTREAM_HEDGE_PERCENTILE)
+    return None if delay is None else max(delay, UPSTREAM_HEDGE_MIN_DELAY)
+
+def _post(stage: str, url: str, body: bytes, headers: Dict[str, str], timeout: float):
+    """One HTTP call on a slot the caller already holds; releases it when done."""
+    try:
+        try:
+            with UPSTREAM_LATENCY.time(stage=stage):
+                response = get_session().post(url, data=body, headers=headers, timeout=timeout)
+        except Exception:
+            UPSTREAM_REQUESTS.inc(stage=stage, status="error")
+            raise
+        UPSTREAM_REQUESTS.inc(stage=stage, status=str(response.status_code))
+        UPSTREAM_BYTES.observe(len(response.content), stage=stage, direction="response")
+        return response
+    finally:
+        SCHEDULER.release()
+
+def _hedged(stage: str, url: str, body: bytes, headers: Dict[str, str], timeout: float, validate: Validator):
+    """
+    One logical attempt: the call, plus a duplicate if it outlives the
+    stage's hedge delay and a slot and retry budget are free right now. The
+    first valid response wins; the loser finishes in the background.
+    """
+    SCHEDULER.acquire()
+    primary = _posts.submit(_post, stage, url, body, headers, timeout)
+    pending = {primary}
+    delay = hedge_delay(stage)
+    if delay is not None and not wait(pending, timeout=delay).done:
+        if SCHEDULER.try_acquire():
+            if RETRY_BUDGET.try_spend():
+                pending.add(_posts.submit(_post, stage, url, body, headers, timeout))
+                UPSTREAM_HEDGES.inc(stage=stage, outcome="sent")
+            else:
+                SCHEDULER.release()
+                UPSTREAM_HEDGES.inc(stage=stage, outcome="no_budget")
+        else:
+            UPSTREAM_HEDGES.inc(stage=stage, outcome="no_slot")
+
+    response = error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                candidate = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if validate(candidate):
+                _window(stage).add(candidate.elapsed.total_seconds())
+                if future is not primary:
+                    UPSTREAM_HEDGES.inc(stage=stage, outcome="won")
+                return candidate
+            response = candidate
+    if response is not None:
+        return response
+    raise error
+
+def _retry_reason(response, error: Optional[Exception]) -> Optional[str]:
+    """Why an attempt is worth retrying, or None if it isn't."""
+    if error is not None:
+        import requests
+        return "connection" if isinstance(error, (requests.ConnectionError, requests.Timeout)) else None
+    if response.status_code in RETRYABLE_STATUS:
+        return f"status_{response.status_code}"
+    if response.status_code == 200:
+        return "invalid_response"
+    return None
+
+def _backoff(attempt: int, response) -> float:
+    """Full-jitter exponential backoff, honouring a short Retry-After."""
+    delay = random.uniform(0, min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(float(retry_after), UPSTREAM_BACKOFF_CAP))
+    return delay
+
+def run_model(stage: str, account_id: str, api_token: str, messages: List[Dict[str, Any]],
+              timeout: Optional[float] = None, validate: Optional[Validator] = None):
+    """
+    POST a chat request to the Workers AI model and return the raw response.
+
+    Waits for an upstream slot from the scheduler according to the calling
+    context's priority, then records latency, status and payload sizes for
+    `stage`. A call slower than the stage's recent p95 is hedged, and
+    connection errors, 408/429/5xx and responses failing `validate` are
+    retried with jittered backoff while the global retry budget allows.
+    Returns the first valid response, else the last one; errors (including
+    a slot timeout) propagate to the caller, which decides on its own
+    fallback.
+    """
+    validate = validate or _status_ok
+    body = json.dumps({"messages": messages}).encode("utf-8")
+    headers = {
+        "Authorization": f"Bearer {api_token}",
+        "Content-Type": "application/json"
+    }
+    url = model_url(account_id)
+    UPSTREAM_BYTES.observe(len(body), stage=stage, direction="request")
+    RETRY_BUDGET.deposit()
+
+    attempt = 0
+    while True:
+        response = error = None
+        try:
+            response = _hedged(stage, url, body, headers, timeout or UPSTREAM_TIMEOUT, validate)
+        except Exception as e:
+            error = e
+        if error is None and validate(response):
+            return response
+
+        reason = _retry_reason(response, error)
+        if reason is None or attempt >= UPSTREAM_MAX_RETRIES:
+            break
+        if not RETRY_BUDGET.try_spend():
+            UPSTREAM_RETRIES.inc(stage=stage, reason="no_budget")
+            break
+        UPSTREAM_RETRIES.inc(stage=stage, reason=reason)
+        time.sleep(_backoff(attempt, response))
+        attempt += 1
+
+    if error is not None:
+        raise error
+    return response
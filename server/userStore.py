@@ -0,0 +1,99 @@
+import os
+import time
+import sqlite3
+from typing import Any, Dict, Optional
+
+from db import SQLitePool
+
+USER_DB_PATH = os.getenv("USER_DB_PATH", "data/users.db")
+USER_DB_POOL_SIZE = int(os.getenv("USER_DB_POOL_SIZE", "8"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    hashed_password TEXT NOT NULL,
+    full_name TEXT
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    token_digest BLOB PRIMARY KEY,
+    email TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_email ON sessions (email);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at);
+"""
+
+def _init_schema(conn: sqlite3.Connection) -> None:
+    conn.executescript(_SCHEMA)
+
+class UserStore:
+    """
+    SQLite-backed users and login sessions, shared by every worker on a host.
+
+    `get` returns the same dict shape the old in-memory USERS_DB held, so
+    callers can treat the store like a read-only mapping.
+    """
+
+    def __init__(self, path: str = USER_DB_PATH, pool_size: int = USER_DB_POOL_SIZE):
+        self.pool = SQLitePool(path, size=pool_size, init=_init_schema)
+
+    def get(self, email: str, default: Any = None) -> Optional[Dict[str, Any]]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT email, hashed_password, full_name FROM users WHERE email = ?",
+                (email,),
+            ).fetchone()
+        if row is None:
+            return default
+        return dict(row)
+
+    def __contains__(self, email: str) -> bool:
+        return self.get(email) is not None
+
+    def add_user(self, email: str, hashed_password: str, full_name: Optional[str] = None) -> bool:
+        """Insert a user unless one already exists. Returns True if inserted."""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (email, hashed_password, full_name) VALUES (?, ?, ?)",
+                (email, hashed_password, full_name),
+            )
+        return cursor.rowcount == 1
+
+    def create_session(self, token_digest: bytes, email: str, expires_at: float) -> None:
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (token_digest, email, expires_at) VALUES (?, ?, ?)",
+                (token_digest, email, expires_at),
+            )
+
+    def get_session(self, token_digest: bytes) -> Optional[Dict[str, Any]]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT email, expires_at FROM sessions WHERE token_digest = ? AND expires_at > ?",
+                (token_digest, time.time()),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def delete_session(self, token_digest: bytes) -> None:
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE token_digest = ?", (token_digest,))
+
+    def purge_expired_sessions(self) -> int:
+        with self.pool.connection() as conn:
+            cursor = conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+        return cursor.rowcount
+
+    async def get_async(self, email: str) -> Optional[Dict[str, Any]]:
+        return await self.pool.run(self.get, email)
+
+    async def create_session_async(self, token_digest: bytes, email: str, expires_at: float) -> None:
+        await self.pool.run(self.create_session, token_digest, email, expires_at)
+
+    async def get_session_async(self, token_digest: bytes) -> Optional[Dict[str, Any]]:
+        return await self.pool.run(self.get_session, token_digest)
+
+    async def delete_session_async(self, token_digest: bytes) -> None:
+        await self.pool.run(self.delete_session, token_digest)
+
+    async def purge_expired_sessions_async(self) -> int:
+        return await self.pool.run(self.purge_expired_sessions)